@@ -0,0 +1,127 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Archive of the raw results of a run, stored by columns in a zip file with
+# the configuration of the run and the host it was run on, so runs can be
+# kept and compared later (compare.py).  A run can also be a directory with
+# an archive for each solution.
+
+import array
+import json
+import os
+import platform
+import sys
+import zipfile
+
+import test_results
+
+METADATA = 'metadata.json'
+VOL_IDS = 'vol_ids'  # Volume of each change, one per line
+
+
+def host_info():
+    """Return information about the host running the tests."""
+    return {'hostname': platform.node(),
+            'platform': platform.platform(),
+            'python': sys.version.split()[0],
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN')}
+
+
+def settings(module):
+    """Return the configuration in a module, values JSON can't store as repr.
+
+    Passwords are left out.
+    """
+    result = {}
+    for name, value in vars(module).iteritems():
+        if not name.isupper() or 'PASS' in name:
+            continue
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            value = repr(value)
+        result[name] = value
+    return result
+
+
+def _store_columns(store):
+    """Return all columns of a ResultStore by name."""
+    columns = dict(store.columns)
+    columns['ok'] = store.ok
+    for ip, column in store.lag.iteritems():
+        columns['lag %s' % ip] = column
+    for phase, column in store.phases.iteritems():
+        columns['phase %s' % phase] = column
+    return columns
+
+
+def save(path, metadata, stores):
+    """Save metadata and the ResultStore of each solution in stores."""
+    metadata = dict(metadata, solutions={})
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for solution, store in stores.iteritems():
+            columns = _store_columns(store)
+            metadata['solutions'][solution] = {
+                name: column.typecode for name, column in columns.iteritems()}
+            for name, column in columns.iteritems():
+                archive.writestr('%s/%s' % (solution, name),
+                                 column.tostring())
+            archive.writestr('%s/%s' % (solution, VOL_IDS),
+                             '\n'.join(v or '' for v in store.vol_ids))
+        archive.writestr(METADATA, json.dumps(metadata, sort_keys=True,
+                                              indent=1))
+
+
+def load(path):
+    """Return metadata and the ResultStore of each solution in a run.
+
+    path can be an archive or a directory of archives of the same run, then
+    the metadata of the solutions and their times are joined.
+    """
+    if os.path.isdir(path):
+        metadata = {}
+        stores = {}
+        for name in sorted(os.listdir(path)):
+            if not name.endswith('.zip'):
+                continue
+            data, solution_stores = _load(os.path.join(path, name))
+            for key in ('solutions', 'total_time', 'setup_time'):
+                metadata.setdefault(key, {}).update(data.pop(key, {}))
+            metadata.update(data)
+            stores.update(solution_stores)
+        return metadata, stores
+    return _load(path)
+
+
+def _load(path):
+    with zipfile.ZipFile(path) as archive:
+        metadata = json.loads(archive.read(METADATA))
+        stores = {}
+        for solution, typecodes in metadata['solutions'].iteritems():
+            store = stores[solution] = test_results.ResultStore()
+            vol_ids = archive.read('%s/%s' % (solution, VOL_IDS))
+            store.vol_ids = [v or None for v in vol_ids.split('\n')]
+            for name, typecode in typecodes.iteritems():
+                column = array.array(str(typecode))
+                column.fromstring(archive.read('%s/%s' % (solution, name)))
+                if name == 'ok':
+                    store.ok = column
+                elif name.startswith('lag '):
+                    store.lag[name[4:]] = column
+                elif name.startswith('phase '):
+                    store.phases[name[6:]] = column
+                else:
+                    store.columns[name] = column
+    return metadata, stores
@@ -0,0 +1,163 @@
+#!/bin/env python
+
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Compare archived runs (see archive.py) with a baseline run and flag
+# statistically significant regressions of latency and throughput of each
+# solution.
+#
+# Usage: compare.py BASELINE RUN [RUN ...]
+#
+# Runs are archives or directories of archives of a run.
+
+from collections import defaultdict
+import itertools as it
+import math
+import sys
+
+import archive
+
+# Significance level of the Mann-Whitney U test
+ALPHA = 0.01
+
+# Smaller relative changes of the median are not flagged, with enough
+# samples even irrelevant changes are significant
+MIN_CHANGE = 0.05
+
+# Seconds of the windows used to sample throughput
+THROUGHPUT_WINDOW = 1.0
+
+
+def mann_whitney(a, b):
+    """Return the two sided p-value of the Mann-Whitney U test.
+
+    Uses the normal approximation with tie correction, which is fine for the
+    number of samples we have.
+    """
+    n1, n2 = len(a), len(b)
+    n = n1 + n2
+    if not n1 or not n2:
+        return 1.0
+
+    values = sorted(it.chain(((v, 0) for v in a), ((v, 1) for v in b)))
+    rank_sum = 0.0
+    ties = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j < n and values[j][0] == values[i][0]:
+            j += 1
+        # Tied values get the average of their ranks
+        rank = (i + j + 1) / 2.0
+        rank_sum += rank * sum(1 for v in values[i:j] if v[1] == 0)
+        ties += (j - i) ** 3 - (j - i)
+        i = j
+
+    u = rank_sum - n1 * (n1 + 1) / 2.0
+    mean = n1 * n2 / 2.0
+    variance = n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (abs(u - mean) - 0.5) / math.sqrt(variance)
+    return math.erfc(max(z, 0) / math.sqrt(2))
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def throughput(store, window=THROUGHPUT_WINDOW):
+    """Return successful changes per second in each window of a run.
+
+    Runs too short to have at least 2 complete windows have a single sample
+    with the rate of the whole run.
+    """
+    finished = [f for f, ok in it.izip(store.columns['finished'], store.ok)
+                if ok]
+    if not finished:
+        return []
+    start = min(finished)
+    counts = defaultdict(int)
+    for f in finished:
+        counts[int((f - start) / window)] += 1
+    # The last window is incomplete
+    windows = max(counts)
+    if windows < 2:
+        span = max(finished) - start
+        return [len(finished) / span] if span > 0 else []
+    return [counts[i] / window for i in xrange(windows)]
+
+
+def samples(store):
+    """Return samples of each metric and if higher values are better."""
+    ok = store.ok
+    return {
+        'acquire': ([v * 1000 for v, o in it.izip(
+            store.columns['acquire'], ok) if o], False),
+        'release': ([v * 1000 for v, o in it.izip(
+            store.columns['release'], ok) if o], False),
+        'throughput': (throughput(store), True)}
+
+
+def compare(baseline, run):
+    """Yield comparisons of the metrics of each solution in both runs."""
+    for solution in sorted(set(baseline) & set(run)):
+        base_samples = samples(baseline[solution])
+        for metric, (values, higher_is_better) in sorted(
+                samples(run[solution]).iteritems()):
+            base_values = base_samples[metric][0]
+            base, new = median(base_values), median(values)
+            # There's no relative change from nothing
+            change = (new - base) / base if base else None
+            p = mann_whitney(base_values, values)
+            flag = ''
+            if (p < ALPHA and change is not None and
+                    abs(change) >= MIN_CHANGE):
+                worse = change < 0 if higher_is_better else change > 0
+                flag = 'REGRESSION' if worse else 'improvement'
+            yield solution, metric, base, new, change, p, flag
+
+
+def main(paths):
+    __, baseline = archive.load(paths[0])
+    regressions = 0
+    for path in paths[1:]:
+        metadata, run = archive.load(path)
+        print '\n%s vs %s (%s)' % (path, paths[0],
+                                   metadata['host']['hostname'])
+        print '%-40s %-10s %10s %10s %8s %8s' % (
+            'solution', 'metric', 'baseline', 'median', 'change', 'p')
+        for solution, metric, base, new, change, p, flag in compare(
+                baseline, run):
+            print '%-40s %-10s %10.2f %10.2f %8s %8.4f %s' % (
+                solution, metric, base, new,
+                'n/a' if change is None else '%.1f%%' % (change * 100), p,
+                flag)
+            regressions += flag == 'REGRESSION'
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'Usage: %s BASELINE RUN [RUN ...]' % sys.argv[0]
+        sys.exit(2)
+    sys.exit(1 if main(sys.argv[1:]) else 0)
@@ -14,17 +14,23 @@
 #    limitations under the License.
 
 import functools
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import threading
 import time
 
-from sqlalchemy import Column, String
+from sqlalchemy import Column, String, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import OperationalError
 import uuid
 import cProfile
 import contextlib
 
+import instrument
+
 
 Base = declarative_base()
 
@@ -37,20 +43,44 @@ class Volume(Base):
     migration_status = Column(String(255))
 
 
+# Volumes inserted in each statement and ids fetched at a time when populating
+POPULATE_CHUNK_SIZE = 10000
+
+
 class WrongDataException(Exception):
     pass
 
 
+def _mysql_engine(user, pwd, ip, db_name, nodes_ips, **engine_args):
+    return create_engine('mysql://%s:%s@%s/%s?charset=utf8' %
+                         (user, pwd, ip, db_name), **engine_args)
+
+
+def _sim_engine(user, pwd, ip, db_name, nodes_ips, **engine_args):
+    import simcluster
+    return simcluster.create_engine(ip, nodes_ips, db_name, **engine_args)
+
+
+# Functions to create the engine for each backend
+BACKENDS = {'mysql': _mysql_engine, 'sim': _sim_engine}
+
+
 class Db(object):
     def __init__(self, user, pwd, ip='127.0.0.1', db_name='cinder',
-                 session_cfg={}, *args, **kwargs):
+                 session_cfg={}, backend='mysql', nodes_ips=(), pool_size=None,
+                 *args, **kwargs):
         self.ip = ip
         self.user = user
         self.pwd = pwd
         self.db_name = db_name
+        self.backend = backend
 
-        self.engine = create_engine('mysql://%s:%s@%s/%s?charset=utf8' %
-                                    (user, pwd, ip, db_name))
+        # Threads sharing the Db need a connection each
+        engine_args = {'pool_size': pool_size} if pool_size else {}
+        self.engine = BACKENDS[backend](user, pwd, ip, db_name, nodes_ips,
+                                        **engine_args)
+        if instrument.enabled:
+            instrument.instrument_engine(self.engine)
 
         # Base.metadata.create_all(engine)
         Base.metadata.bind = self.engine
@@ -66,7 +96,12 @@ class Db(object):
             model.metadata.create_all(self.engine)
 
     def close(self):
-        self.session.close()
+        """Close the engine's connections and this thread's session.
+
+        Sessions of other threads are not removed, any connection they have
+        checked out is closed when they are done with it.
+        """
+        self.session.remove()
         self.engine.dispose()
 
     def get_engine(self):
@@ -74,32 +109,68 @@ class Db(object):
 
     def create_session(self, autocommit=True, expire_on_commit=True,
                        *args, **kwargs):
-        return sessionmaker(bind=self.engine, autocommit=autocommit,
-                            expire_on_commit=expire_on_commit, *args,
-                            **kwargs)()
+        # Each thread using the Db gets its own session
+        return scoped_session(sessionmaker(bind=self.engine,
+                                           autocommit=autocommit,
+                                           expire_on_commit=expire_on_commit,
+                                           *args, **kwargs))
 
     @property
     def current_uuids(self):
-        return map(lambda x: x[0], self.session.query(Volume.id).all())
-
-    def populate(self, num_volumes=10):
+        return self.get_uuids()
+
+    def get_uuids(self, limit=None):
+        """Return ids of up to limit volumes, or all of them."""
+        query = self.session.query(Volume.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return [row[0] for row in query.yield_per(POPULATE_CHUNK_SIZE)]
+
+    def populate(self, num_volumes=10, chunk_size=POPULATE_CHUNK_SIZE):
+        """Make sure there are num_volumes volumes and they are available.
+
+        Missing volumes are inserted with multi-row inserts of chunk_size
+        rows, each in its own transaction, so tables with millions of rows
+        can be created quickly and without huge write-sets.
+        """
         with self.session.begin():
-            missing = num_volumes - self.session.query(Volume).count()
-            self.session.query(Volume).update({Volume.status: 'available'})
-            if missing > 0:
-                for __ in xrange(missing):
-                    self.session.add(Volume(id=uuid.uuid1(),
-                                            status='available'))
-
-    def check_volume(self, vol_id, data):
+            self.session.query(Volume).filter(
+                Volume.status != 'available').update(
+                    {Volume.status: 'available'}, synchronize_session=False)
+            count = self.session.query(func.count(Volume.id)).scalar()
+
+        insert = Volume.__table__.insert()
+        missing = num_volumes - count
+        while missing > 0:
+            rows = [{'id': str(uuid.uuid1()), 'status': 'available'}
+                    for __ in xrange(min(missing, chunk_size))]
+            with self.engine.begin() as conn:
+                conn.execute(insert, rows)
+            missing -= len(rows)
+
+    def is_alive(self):
+        """Check that the server is still reachable."""
+        try:
+            self.session.execute('SELECT 1')
+        except OperationalError as e:
+            if match_operational_error(e, RETRY_DISCONNECTS):
+                return False
+            raise
+        return True
+
+    def get_volume_data(self, vol_id, keys):
         with self.session.begin():
             vol = self.session.query(Volume).get(vol_id)
-            for k, v in data.iteritems():
-                d = getattr(vol, k)
-                if d != v:
-                    raise WrongDataException(
-                        'Wrong data in server %s in %s, key %s, %s != %s' %
-                        (self.ip, vol_id, k, v, d))
+            return {k: getattr(vol, k) for k in keys}
+
+    def check_volume(self, vol_id, data):
+        current = self.get_volume_data(vol_id, data.keys())
+        for k, v in data.iteritems():
+            d = current[k]
+            if d != v:
+                raise WrongDataException(
+                    'Wrong data in server %s in %s, key %s, %s != %s' %
+                    (self.ip, vol_id, k, v, d))
 
 
 @contextlib.contextmanager
@@ -111,11 +182,12 @@ def profiled(enabled=True):
     pr.disable()
 
 
-def populate_database(db_data, num_rows):
+def populate_database(db_data, num_rows, table_rows=0):
+    """Populate the table with at least table_rows and return num_rows ids."""
     database = Db(**db_data)
     database.create_table()
-    database.populate(num_rows)
-    uuids = database.current_uuids[:num_rows]
+    database.populate(max(num_rows, table_rows))
+    uuids = database.get_uuids(num_rows)
     database.close()
     return (uuids)
 
@@ -127,31 +199,199 @@ RETRY_GONE2 = ('disconnect', 2013, 'Lost connection to MySQL')
 RETRY_GONE3 = ('disconnect', 2014, 'Lost connection to MySQL')
 RETRY_GONE4 = ('disconnect', 2045, 'Lost connection to MySQL')
 RETRY_GONE5 = ('disconnect', 2055, 'Lost connection to MySQL')
-ALL_RETRIES = (RETRY_TIMEOUT, RETRY_DEADLOCKS, RETRY_GONE, RETRY_GONE2,
-               RETRY_GONE3, RETRY_GONE4, RETRY_GONE5)
+RETRY_DISCONNECTS = (RETRY_GONE, RETRY_GONE2, RETRY_GONE3, RETRY_GONE4,
+                     RETRY_GONE5)
+ALL_RETRIES = (RETRY_TIMEOUT, RETRY_DEADLOCKS) + RETRY_DISCONNECTS
+
+HEALTH_CHECK_INTERVAL = 30  # Seconds a pooled Db can be idle without checks
+
+
+def match_operational_error(e, which_cases):
+    """Return the case from which_cases that matches e or None."""
+    # Prefer the DBAPI error code, the message format depends on SQLAlchemy
+    code = getattr(getattr(e, 'orig', None), 'args', (None,))[0]
+    for case in which_cases:
+        if (code == case[1] or
+                e.args[0].startswith("(OperationalError) (%d, '%s" %
+                                     (case[1], case[2]))):
+            return case
+    return None
+
+
+class DbPool(object):
+    """Process wide pool of Db instances keyed by node IP.
+
+    Instances are created on first use and reused for the whole run, and
+    those that have been idle for a while are checked before being returned
+    and recreated if the server has gone away.
+    """
+    def __init__(self, check_interval=HEALTH_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._reset()
+
+    def _reset(self):
+        # Connections inherited from a parent process must not be used, and
+        # closing them would close them in the parent as well.
+        self.pid = os.getpid()
+        self.dbs = {}
+        self.last_used = {}
+        self.lock = threading.RLock()
+
+    def get(self, db_cfg, ip=None, session_cfg=None):
+        if self.pid != os.getpid():
+            self._reset()
+
+        with self.lock:
+            return self._get(db_cfg, ip, session_cfg)
+
+    def _get(self, db_cfg, ip, session_cfg):
+        ip = ip or db_cfg['ip']
+        session_cfg = session_cfg or {}
+        key = (ip, tuple(sorted(session_cfg.items())))
+        now = time.time()
+
+        database = self.dbs.get(key)
+        if (database and now - self.last_used[key] > self.check_interval
+                and not database.is_alive()):
+            self.invalidate(ip)
+            database = None
+
+        if not database:
+            cfg = db_cfg.copy()
+            cfg.update(ip=ip, session_cfg=session_cfg)
+            database = self.dbs[key] = Db(**cfg)
+
+        self.last_used[key] = now
+        return database
+
+    def invalidate(self, ip):
+        """Discard all instances connected to a node so they reconnect."""
+        with self.lock:
+            for key in [k for k in self.dbs if k[0] == ip]:
+                database = self.dbs.pop(key)
+                del self.last_used[key]
+                try:
+                    database.close()
+                except Exception:
+                    pass
+
+    def close(self):
+        for ip in set(k[0] for k in self.dbs):
+            self.invalidate(ip)
+
+
+db_pool = DbPool()
+
 
+class RetryPolicy(object):
+    """Fixed wait between retries of a DB API call.
 
-def retry_on_operational_error(method_or_which_cases):
-    """Decorator to retry a DB API call if Deadlock was received."""
+    Waits are capped to cap seconds if given, and budgets can limit how many
+    times each class of error in ALL_RETRIES (deadlocks, timeouts,
+    disconnect) is retried, errors without a budget are retried forever.
+    """
+    def __init__(self, base=0.01, cap=None, budgets=None):
+        self.base = base
+        self.cap = cap
+        self.budgets = budgets or {}
+
+        unknown = set(self.budgets) - set(case[0] for case in ALL_RETRIES)
+        if unknown:
+            raise ValueError('Unknown error classes %s' % ', '.join(unknown))
+
+    def __repr__(self):
+        # Sorted and without addresses, as it's part of tests' configuration
+        values = []
+        for name, value in sorted(vars(self).items()):
+            if isinstance(value, dict):
+                value = '{%s}' % ', '.join('%r: %r' % item
+                                           for item in sorted(value.items()))
+            else:
+                value = repr(value)
+            values.append('%s=%s' % (name, value))
+        return '%s(%s)' % (type(self).__name__, ', '.join(values))
+
+    def backoff(self, attempt, previous):
+        """Return seconds to wait before retry attempt (starting at 1)."""
+        return self.base
+
+    def wait_time(self, attempt, previous):
+        wait = self.backoff(attempt, previous)
+        if self.cap is not None:
+            wait = min(wait, self.cap)
+        return wait
+
+    def exhausted(self, case, retries):
+        budget = self.budgets.get(case[0])
+        return budget is not None and retries > budget
+
+
+class ExponentialBackoff(RetryPolicy):
+    """Wait base * factor^(attempt - 1) with optional full jitter."""
+    def __init__(self, base=0.01, factor=2, jitter=False, *args, **kwargs):
+        super(ExponentialBackoff, self).__init__(base, *args, **kwargs)
+        self.factor = factor
+        self.jitter = jitter
+
+    def backoff(self, attempt, previous):
+        wait = self.base * self.factor ** (attempt - 1)
+        if self.jitter:
+            wait = random.uniform(0, wait)
+        return wait
+
+
+class DecorrelatedJitter(RetryPolicy):
+    """Wait a random time between base and 3 times the previous wait."""
+    def backoff(self, attempt, previous):
+        return random.uniform(self.base, max(previous, self.base) * 3)
+
+
+# Policy used by retry_on_operational_error when none is given
+retry_policy = RetryPolicy(0.01)
+
+
+def set_retry_policy(policy):
+    global retry_policy
+    retry_policy = policy
+
+
+def retry_on_operational_error(method_or_which_cases=ALL_RETRIES,
+                               policy=None):
+    """Decorator to retry a DB API call if Deadlock was received.
+
+    Returns the number of retries for each class of error and the time spent
+    waiting between retries in the 'backoff' key, plus any counters returned
+    by the call in a dictionary.
+    """
     def wrapper(f, which_cases=method_or_which_cases):
         @functools.wraps(f)
         def wrapped(session, *args, **kwargs):
+            retries = policy or retry_policy
             result = {case[0]: 0 for case in which_cases}
+            result['backoff'] = 0.0
+            attempt = 0
+            wait = 0.0
             while True:
                 try:
-                    f(session, *args, **kwargs)
+                    counters = f(session, *args, **kwargs)
+                    if isinstance(counters, dict):
+                        for k, v in counters.iteritems():
+                            result[k] = result.get(k, 0) + v
                     return result
                 except OperationalError as e:
-                    for case in which_cases:
-                        if e.args[0].startswith("(OperationalError) (%d, '%s" %
-                                                (case[1], case[2])):
-                            result[case[0]] += 1
-                            break
-                    else:
+                    case = match_operational_error(e, which_cases)
+                    if not case:
+                        raise
+                    result[case[0]] += 1
+                    if retries.exhausted(case, result[case[0]]):
                         raise
 
                     # We wait a little bit before retrying
-                    time.sleep(0.01)
+                    attempt += 1
+                    wait = retries.wait_time(attempt, wait)
+                    with instrument.timer('backoff'):
+                        time.sleep(wait)
+                    result['backoff'] += wait
 
         functools.update_wrapper(wrapped, f)
         return wrapped
@@ -162,31 +402,140 @@ def retry_on_operational_error(method_or_which_cases):
     return wrapper
 
 
-def check_volume(LOG, db_cfg, vol_id, data):
-    """Check that a volumes has the same data in all cluster nodes."""
-    def _check_volume(dbs):
-        for node in dbs:
-            LOG.debug('Checking node %s for %s', node.ip, data)
-            node.check_volume(vol_id, data)
-            LOG.debug('\tdata on %s is ok', node.ip)
+# Most threads checking each node at the same time in a process, so
+# processes with many threaded workers don't need thousands of threads
+MAX_CHECKS_PER_NODE = 8
+
+_check_pool = None
+_check_pool_lock = threading.Lock()
+
+# Workers of this process that may be checking volumes at the same time
+check_concurrency = 1
+
+
+def set_check_concurrency(concurrency):
+    global check_concurrency
+    check_concurrency = concurrency
+
+
+def _get_check_pool(size):
+    """Return this process' thread pool used to query nodes concurrently."""
+    global _check_pool
+    with _check_pool_lock:
+        if not _check_pool or _check_pool.pid != os.getpid():
+            _check_pool = ThreadPool(
+                processes=max(size, 1) * min(check_concurrency,
+                                             MAX_CHECKS_PER_NODE))
+            _check_pool.pid = os.getpid()
+    return _check_pool
+
+
+def _check_node(args):
+    node, vol_id, data = args
+    try:
+        node.check_volume(vol_id, data)
+    except Exception as e:
+        return e
+    return None
+
+
+def _poll_node(args):
+    node, vol_id, data, start, poll_interval, timeout = args
+    deadline = start + timeout
+    try:
+        while True:
+            current = node.get_volume_data(vol_id, data.keys())
+            now = time.time()
+            if current == data:
+                return now - start
+            if now > deadline:
+                return None
+            time.sleep(poll_interval)
+    except Exception as e:
+        return e
+
+
+def _warm_up_node(node):
+    return node.is_alive()
+
+
+def warm_up(db_cfg, session_cfg=None):
+    """Connect to the database and its nodes and return the Db for changes.
+
+    Creates the engines, this thread's session and the pool used to check
+    the nodes, so the first changes and checks don't have to.
+    """
+    database = db_pool.get(db_cfg, session_cfg=session_cfg)
+    database.is_alive()
+    nodes = [db_pool.get(db_cfg, ip) for ip in db_cfg.get('nodes_ips', [])]
+    if nodes:
+        _get_check_pool(len(nodes)).map(_warm_up_node, nodes)
+    return database
+
+
+def measure_replication_lag(LOG, db_cfg, vol_id, data, start,
+                            poll_interval=0.001, timeout=10):
+    """Measure how long it takes for a change to reach each cluster node.
+
+    Each node is polled concurrently every poll_interval seconds from start
+    until it shows the expected data.  Returns a dictionary with the lag in
+    seconds for each node's IP.
+    """
+    nodes_ips = db_cfg.get('nodes_ips', [])
+    nodes = [db_pool.get(db_cfg, ip) for ip in nodes_ips]
+    lags = _get_check_pool(len(nodes)).map(
+        _poll_node,
+        [(node, vol_id, data, start, poll_interval, timeout)
+         for node in nodes])
+
+    result = {}
+    for ip, lag in zip(nodes_ips, lags):
+        if isinstance(lag, Exception):
+            if (isinstance(lag, OperationalError)
+                    and match_operational_error(lag, RETRY_DISCONNECTS)):
+                db_pool.invalidate(ip)
+            raise lag
+        if lag is None:
+            raise WrongDataException(
+                'Data %s for %s did not reach server %s in %.2f seconds' %
+                (data, vol_id, ip, timeout))
+        LOG.debug('\tdata on %s after %.2fms', ip, lag * 1000)
+        result[ip] = lag
+    return result
 
-    def _close_dbs(dbs):
-        for node in dbs:
-            node.close()
 
-    def _create_dbs(db_cfg):
-        db_cfg = db_cfg.copy()
-        del db_cfg['ip']
-        return tuple(Db(ip=ip, **db_cfg) for ip in db_cfg.get('nodes_ips', []))
-
-    dbs = _create_dbs(db_cfg)
+def check_volume(LOG, db_cfg, vol_id, data):
+    """Check that a volumes has the same data in all cluster nodes.
+
+    All nodes are queried concurrently and their results compared together,
+    so the cost of a check is that of the slowest node.
+    """
+    def _check_volume(nodes_ips):
+        nodes = [db_pool.get(db_cfg, ip) for ip in nodes_ips]
+        LOG.debug('Checking nodes %s for %s', nodes_ips, data)
+        errors = _get_check_pool(len(nodes)).map(
+            _check_node, [(node, vol_id, data) for node in nodes])
+
+        for ip, e in zip(nodes_ips, errors):
+            # Reconnect on next try if the server has gone away
+            if (isinstance(e, OperationalError)
+                    and match_operational_error(e, RETRY_DISCONNECTS)):
+                db_pool.invalidate(ip)
+
+        errors = [e for e in errors if e]
+        if errors:
+            # Data errors take precedence as they are the ones that count
+            wrong = [e for e in errors if isinstance(e, WrongDataException)]
+            raise (wrong or errors)[0]
+        LOG.debug('\tdata on %s is ok', nodes_ips)
+
+    nodes_ips = db_cfg.get('nodes_ips', [])
 
     num_tries = 6
     i = 0
     while True:
         try:
-            _check_volume(dbs)
-            _close_dbs(dbs)
+            _check_volume(nodes_ips)
             return
         except Exception as e:
             if i < num_tries - 1:
@@ -199,5 +548,4 @@ def check_volume(LOG, db_cfg, vol_id, data):
                 time.sleep(0.25 * (i+1))
             else:
                 LOG.error('Checking %s', data)
-                _close_dbs(dbs)
                 raise
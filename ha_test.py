@@ -16,13 +16,20 @@
 #    limitations under the License.
 
 import cProfile
+from collections import defaultdict
+import functools
 import gc
 import itertools as it
 import logging
 import os
+import sys
 import time
 
+import archive
 import db
+import instrument
+import lockserver
+import notify
 import test_results
 import worker
 from workloaders import db_rw as wl_generator
@@ -30,16 +37,34 @@ from workloaders import db_rw as wl_generator
 DB_NAME = 'cinder'
 
 NUM_ROWS = 100  # How many different rows are available
+# Volumes in the table, only NUM_ROWS of them are changed by the tests but
+# large tables are more like what large clouds have
+TABLE_ROWS = 0
 WORKERS_PER_ROW = 3  # How many workes will be fighting for each row
 NUM_TESTS_PER_WORKER = 10  # How many deleting-available changes to make
 DELETE_TIME = 0.01  # Simulated delete time
 
+# Volumes each worker changes at once, rows are split in batches and there
+# are WORKERS_PER_ROW workers fighting for each batch
+BATCH_SIZE = 1
+
 SYN_DB_UPDATES_PER_GENERATOR = 5
 SYN_DB_SELECTS_PER_GENERATOR = 10
 SYN_DB_GENERATORS = 50
-
-NUM_WORKERS = NUM_ROWS*WORKERS_PER_ROW
-
+# Start synthetic operations at Poisson arrival times for the rates above
+# instead of waiting a fixed time after each one, so the offered load doesn't
+# drop when the DB is slow, and report their latency
+SYN_DB_OPEN_LOOP = False
+# Run synthetic workload generators as threads with up to this many per
+# process sharing the DB engine, instead of a process for each one
+SYN_DB_GENERATORS_PER_PROCESS = 1
+
+# Run workers as threads with up to this many per process instead of having
+# a process for each worker, for tests with thousands of workers
+WORKERS_PER_PROCESS = 1
+
+# Use 'sim' to run against a simulated cluster on this box (simcluster.py)
+DB_BACKEND = 'mysql'
 HAPROXY_IP = '192.168.1.14'
 DB_NODES = ('192.168.1.15', '192.168.1.16', '192.168.1.17')
 DB_USER = 'wsrep_sst'
@@ -47,8 +72,35 @@ DB_PASS = 'wspass'
 
 OUTPUT_FILE = os.getcwd() + '/results.csv'
 
+# Directory where the raw results of each run are archived along with the
+# configuration, None to disable it.  Compare runs with compare.py
+ARCHIVE_DIR = os.getcwd() + '/runs'
+
+# Write changes, errors, retries and latencies in windows of this many seconds
+# to TIMELINE_FILE for each solution, None to disable it
+TIMELINE_WINDOW = 1.0
+TIMELINE_FILE = os.getcwd() + '/timeline-%s.csv'
+
+# Write acquire waits and lost races of each worker for each solution
+WORKERS_FILE = os.getcwd() + '/workers-%s.csv'
+
 ENABLE_PROFILING = False
 
+# Report time spent on each phase of the changes (lock wait, SQL, commit,
+# replication check and backoff), with much less overhead than profiling
+INSTRUMENT_PHASES = True
+
+PROGRESS_INTERVAL = 10  # Seconds between partial results while testing
+
+# Measure replication lag polling each node after acquiring a volume instead
+# of checking with retries and growing sleeps
+MEASURE_LAG = False
+LAG_POLL_INTERVAL = 0.001  # Seconds between polls when measuring lag
+
+# Retry policy for DB errors unless the solution defines its own retry_policy
+# ie: db.ExponentialBackoff(0.01, cap=0.5, budgets={'deadlocks': 50})
+RETRY_POLICY = db.RetryPolicy(0.01)
+
 LOG = logging
 LOG.basicConfig(
     level=logging.WARNING,
@@ -70,21 +122,69 @@ def do_change(changer, profile, session, vol_id, initial, destination, marker,
     return time_end - time_start
 
 
+def change_batch(changer, session, vol_ids, initial, destination,
+                 attach_status):
+    """Change a batch of volumes one by one with a solution's make_change.
+
+    Used for solutions that can't change many volumes at once.  Volumes are
+    always changed in the same order so workers can't hold part of the batch
+    each waiting for the other.
+    """
+    result = defaultdict(int)
+    for vol_id in sorted(vol_ids):
+        r = changer(session, vol_id, initial, destination, attach_status)
+        for k, v in r.iteritems():
+            result[k] += v
+    return result
+
+
+def batch_changer(solution):
+    """Return the function to change a batch of volumes with a solution."""
+    if hasattr(solution, 'make_batch_change'):
+        return solution.make_batch_change
+    return functools.partial(change_batch, solution.make_change)
+
+
 def do_test(worker_id, num_tests, db_data, changer, session_cfg={},
-            vol_id=None, delete_time=0.01, *args, **kwargs):
+            vol_id=None, delete_time=0.01, measure_lag=False,
+            lag_poll_interval=0.001, retry_policy=None, check_concurrency=1,
+            phases=False, warm_up=None, *args, **kwargs):
     """Perform tests for atomic changes of rows in the database.
 
     Will perform num_tests changes from available to deleting and back to
     available, always checking that changes are consistent across all nodes of
-    the database.
+    the database.  When measure_lag is set the check also records how long
+    each node took to show the change.
+
+    vol_id can also be a tuple of volumes for changers that change batches.
+    check_concurrency is the number of workers in this process that may be
+    checking volumes at the same time, and with phases the time spent on each
+    phase of the changes is reported.
+
+    Connections to the database, and to whatever the solution uses if
+    warm_up is given, are made before waiting for the other workers to be
+    ready, so they are not part of the measured time.
     """
+    if retry_policy:
+        db.set_retry_policy(retry_policy)
+    db.set_check_concurrency(check_concurrency)
+    # Must be enabled before creating the engines
+    if phases:
+        instrument.enable()
+
     db_cfg = db_data.copy()
-    database = db.Db(session_cfg=session_cfg, **db_cfg)
+    try:
+        database = db.warm_up(db_cfg, session_cfg)
+        if warm_up:
+            warm_up()
+        vol_id = vol_id or database.get_uuids(1)[0]
+    finally:
+        worker.wait_start()
 
     session = database.session
 
     results = []
-    vol_id = vol_id or database.current_uuids[0]
+    vol_ids = vol_id if isinstance(vol_id, tuple) else (vol_id,)
 
     if not ENABLE_PROFILING:
         fake = lambda *args, **kwargs: tuple()
@@ -94,25 +194,41 @@ def do_test(worker_id, num_tests, db_data, changer, session_cfg={},
         profile = cProfile.Profile()
 
     for i in xrange(num_tests):
-        result = test_results.ResultDataPoint(worker=worker_id, num_test=i)
+        result = test_results.ResultDataPoint(worker=worker_id, num_test=i,
+                                              vol_id=','.join(vol_ids))
         try:
             marker = '%s_%s' % (worker_id, i)
 
             LOG.info('Start %s', marker)
             time.sleep(0.01)
+            instrument.collect()
             profile.enable()
 
             # make change to deleting, measure and profile it
             result.acquire = do_change(changer, profile, session, vol_id,
                                        'available', 'deleting', marker, result)
+            written = time.time()
+            result.lost = result.polls + result.deadlocks + result.timeouts
 
             # check that it's changed in all nodes
             LOG.info('Checking deleting %s', marker)
             try:
                 ex = None
-                db.check_volume(LOG, db_cfg, vol_id,
-                                {'status': 'deleting',
-                                 'attach_status': marker})
+                data = {'status': 'deleting', 'attach_status': marker}
+                with instrument.timer('replication_check'):
+                    if measure_lag:
+                        # A batch reaches a node when its last volume does
+                        result.lag = {}
+                        for v in vol_ids:
+                            lag = db.measure_replication_lag(
+                                LOG, db_cfg, v, data, written,
+                                lag_poll_interval)
+                            for ip, node_lag in lag.iteritems():
+                                result.lag[ip] = max(result.lag.get(ip, 0),
+                                                     node_lag)
+                    else:
+                        for v in vol_ids:
+                            db.check_volume(LOG, db_cfg, v, data)
             except Exception as e:
                 ex = e
                 LOG.error('On check volume %s: %s', marker, ex)
@@ -131,10 +247,13 @@ def do_test(worker_id, num_tests, db_data, changer, session_cfg={},
             LOG.error('On %s: %s', marker, e)
             result.status = 'Exception %s' % e
         finally:
+            result.finished = time.time()
             result.profile = test_results.map_profile_info(profile)
-            results.append(result)
+            if phases:
+                result.phases = instrument.collect()
+            if not worker.report(result):
+                results.append(result)
 
-    database.close()
     LOG.info('Worker %s has finished', worker_id)
     return results
 
@@ -151,66 +270,183 @@ def get_solutions():
     return map(lambda name: import_module(name, package), solution_names)
 
 
+def _consume_all(consumers, result):
+    for consumer in consumers:
+        consumer(result)
+
+
+def get_db_data():
+    """Return the DB connection settings for the tests."""
+    return {
+        'user': DB_USER,
+        'pwd': DB_PASS,
+        'ip': HAPROXY_IP,
+        'db_name': DB_NAME,
+        'nodes_ips': DB_NODES,
+        'backend': DB_BACKEND}
+
+
+def test_solution(solution, db_data, uuids, workers_per_row, num_tests,
+                  batch_size, syn_generators, syn_selects, syn_updates,
+                  timeline_file=None, store=None, workers_file=None):
+    """Test a solution changing uuids and return the summary of results.
+
+    Volumes are split in batches of batch_size, and there will be
+    workers_per_row workers fighting for each of them.  The timeline of the
+    results is written to timeline_file if TIMELINE_WINDOW is set, waits and
+    lost races of each worker to workers_file, and the results of each
+    change are also added to store if given.
+    """
+    num_rows = len(uuids)
+    if batch_size > 1:
+        uuids = [tuple(uuids[i:i + batch_size])
+                 for i in xrange(0, len(uuids), batch_size)]
+    num_workers = len(uuids) * workers_per_row
+
+    print '\nRunning', solution.__name__
+    print '\t%d workers' % num_workers
+    print '\t%d rows' % num_rows
+    if batch_size > 1:
+        print '\t%d rows per change' % batch_size
+    print '\t%d changes per worker' % num_tests
+    print ('\t%d synthetic workload generators with %d selects and '
+           '%d updates per second' % (syn_generators, syn_selects,
+                                      syn_updates))
+    if SYN_DB_OPEN_LOOP:
+        print '\twith Poisson arrivals (open loop)'
+    if MEASURE_LAG:
+        print '\tmeasuring replication lag'
+
+    if batch_size > 1:
+        changer = batch_changer(solution)
+    else:
+        changer = solution.make_change
+
+    if WORKERS_PER_PROCESS > 1:
+        # Threads of a process share DB engines, so they need bigger pools
+        new_tester = functools.partial(worker.ThreadedTester,
+                                       WORKERS_PER_PROCESS)
+        test_db_data = dict(db_data, pool_size=WORKERS_PER_PROCESS)
+    else:
+        new_tester = worker.Tester
+        test_db_data = db_data
+
+    testers = new_tester(
+        do_test,
+        it.cycle({'args': (uuid,)} for uuid in uuids),
+        num_tests,
+        test_db_data,
+        changer,
+        solution.session_cfg,
+        delete_time=DELETE_TIME,
+        measure_lag=MEASURE_LAG,
+        lag_poll_interval=LAG_POLL_INTERVAL,
+        retry_policy=getattr(solution, 'retry_policy', RETRY_POLICY),
+        check_concurrency=WORKERS_PER_PROCESS,
+        phases=INSTRUMENT_PHASES,
+        warm_up=getattr(solution, 'warm_up', None))
+
+    if SYN_DB_GENERATORS_PER_PROCESS > 1:
+        new_workloader = functools.partial(worker.ThreadedWorkloader,
+                                           SYN_DB_GENERATORS_PER_PROCESS)
+        workload_db_data = dict(db_data,
+                                pool_size=SYN_DB_GENERATORS_PER_PROCESS)
+    else:
+        new_workloader = worker.Workloader
+        workload_db_data = db_data
+
+    workloads = new_workloader(
+        wl_generator.do_workload,
+        None,
+        workload_db_data,
+        num_selects=syn_selects,
+        num_updates=syn_updates,
+        open_loop=SYN_DB_OPEN_LOOP)
+
+    # start workload generators
+    workload_results = []
+    workloads.run(syn_generators, workload_results.append)
+
+    # test solution, results are aggregated as workers report them
+    aggregator = test_results.Aggregator(TIMELINE_WINDOW)
+    consumers = [aggregator.add]
+    if store is not None:
+        consumers.append(store.add)
+
+    testers.run(num_workers, functools.partial(_consume_all, consumers),
+                functools.partial(test_results.display_progress, aggregator),
+                PROGRESS_INTERVAL, synchronize=True,
+                started=aggregator.set_start)
+
+    # stop workload generators
+    workloads.finish()
+
+    summary = aggregator.summary(solution,
+                                 testers.end_time - testers.start_time,
+                                 testers.setup_time)
+    if workload_results:
+        summary.stats.update(test_results.workload_stats(workload_results))
+    if aggregator.timeline and timeline_file:
+        test_results.write_timeline(timeline_file, aggregator.timeline)
+    if workers_file:
+        test_results.write_fairness(workers_file, aggregator.fairness)
+
+    del workloads
+    del testers
+    del aggregator
+    gc.collect()
+
+    return summary
+
+
 if __name__ == '__main__':
     # get all solutions from solutions directory
     solutions = get_solutions()
     summaries = []
 
     # populate the database with enough different volumes
-    db_data = {
-        'user': DB_USER,
-        'pwd': DB_PASS,
-        'ip': HAPROXY_IP,
-        'db_name': DB_NAME,
-        'nodes_ips': DB_NODES}
-    uuids = db.populate_database(db_data, NUM_ROWS)
+    db_data = get_db_data()
+    uuids = db.populate_database(db_data, NUM_ROWS, TABLE_ROWS)
+
+    # start the broker used by solutions that wait for notifications
+    broker = notify.Broker()
+    broker.start()
+    # and the lock server used by the fifo DLM solutions
+    lock_server = lockserver.LockServer()
+    lock_server.start()
+
+    # Each solution is archived as soon as it finishes, in a directory for
+    # the run, so we don't keep all results in memory or lose them on errors
+    started = time.time()
+    run_dir = ARCHIVE_DIR and os.path.join(
+        ARCHIVE_DIR, time.strftime('%Y%m%d-%H%M%S', time.localtime(started)))
+    if run_dir:
+        os.makedirs(run_dir)
 
     for solution in solutions:
-        print '\nRunning', solution.__name__
-        print '\t%d workers' % NUM_WORKERS
-        print '\t%d rows' % NUM_ROWS
-        print '\t%d changes per worker' % NUM_TESTS_PER_WORKER
-        print ('\t%d synthetic workload generators with %d selects and '
-               '%d updates per second' % (SYN_DB_GENERATORS,
-                                          SYN_DB_SELECTS_PER_GENERATOR,
-                                          SYN_DB_UPDATES_PER_GENERATOR))
-
-        testers = worker.Tester(
-            do_test,
-            it.cycle({'args': (uuid,)} for uuid in uuids),
-            NUM_TESTS_PER_WORKER,
-            db_data,
-            solution.make_change,
-            solution.session_cfg,
-            delete_time=DELETE_TIME)
-
-        workloads = worker.Workloader(
-            wl_generator.do_workload,
-            None,
-            db_data,
-            num_selects=SYN_DB_SELECTS_PER_GENERATOR,
-            num_updates=SYN_DB_UPDATES_PER_GENERATOR)
-
-        # start workload generators
-        workloads.run(SYN_DB_GENERATORS)
-
-        # test solution
-        start = time.time()
-        result = tuple(it.chain(*testers.run(NUM_WORKERS)))
-        end = time.time()
-
-        # stop workload generators
-        workloads.finish()
-
-        summary = test_results.summarize(solution, end - start, result)
+        name = solution.__name__.split('.')[-1]
+        store = test_results.ResultStore() if run_dir else None
+        summary = test_solution(
+            solution, db_data, uuids, WORKERS_PER_ROW, NUM_TESTS_PER_WORKER,
+            BATCH_SIZE, SYN_DB_GENERATORS, SYN_DB_SELECTS_PER_GENERATOR,
+            SYN_DB_UPDATES_PER_GENERATOR, TIMELINE_FILE % name, store,
+            WORKERS_FILE % name)
         summaries.append(summary)
 
-        del workloads
-        del testers
-        del result
-        gc.collect()
+        if run_dir:
+            archive.save(
+                os.path.join(run_dir, name + '.zip'),
+                {'started': started,
+                 'config': archive.settings(sys.modules[__name__]),
+                 'host': archive.host_info(),
+                 'total_time': {summary.solution: summary.total_time},
+                 'setup_time': {summary.solution: summary.setup_time}},
+                {summary.solution: store})
+            del store
 
         test_results.display_results(summary)
         time.sleep(1)
 
+    broker.stop()
+    lock_server.stop()
     test_results.write_csv(OUTPUT_FILE, summaries)
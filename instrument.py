@@ -0,0 +1,112 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Low overhead timing of the phases of a change (SQL, commit, lock wait...)
+# with SQLAlchemy events and explicit timers.  Times are accumulated for each
+# thread until they are collected.
+
+from collections import defaultdict
+import contextlib
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Phases every change reports, even if no time was spent in them
+PHASES = ('lock_wait', 'sql', 'commit', 'replication_check', 'backoff')
+
+enabled = False
+
+_local = threading.local()
+_enable_lock = threading.Lock()
+
+
+def enable():
+    """Start timing phases, must be called before creating the engines."""
+    global enabled
+    # Threads of a process all enable it, listeners must be added only once
+    with _enable_lock:
+        if enabled:
+            return
+        # Listeners for the class run before the ones for each engine, like
+        # the simulated cluster's, which may do part of the work
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+        event.listen(Engine, 'commit', _on_commit)
+        enabled = True
+
+
+def _phases():
+    phases = getattr(_local, 'phases', None)
+    if phases is None:
+        phases = _local.phases = defaultdict(float)
+    return phases
+
+
+def add(phase, seconds):
+    if enabled:
+        _phases()[phase] += seconds
+
+
+def collect():
+    """Return seconds spent in each phase by this thread and reset them."""
+    phases = _phases()
+    _local.phases = None
+    result = dict.fromkeys(PHASES, 0.0)
+    result.update(phases)
+    return result
+
+
+@contextlib.contextmanager
+def timer(phase):
+    if not enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        add(phase, time.time() - start)
+
+
+def _before_execute(conn, cursor, statement, params, context, executemany):
+    conn.info['instrument_sql'] = time.time()
+
+
+def _after_execute(conn, cursor, statement, params, context, executemany):
+    add('sql', time.time() - conn.info.pop('instrument_sql'))
+
+
+def _on_commit(conn):
+    _local.commit = time.time()
+
+
+def instrument_engine(engine):
+    """Time commits run by an engine."""
+    # There's no event after the commit, so time the dialect's commit
+    do_commit = engine.dialect.do_commit
+
+    def timed_commit(dbapi_connection):
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            start = getattr(_local, 'commit', None)
+            if start:
+                _local.commit = None
+                add('commit', time.time() - start)
+
+    engine.dialect.do_commit = timed_commit
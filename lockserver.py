@@ -0,0 +1,251 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Local lock server and a tooz-like coordinator to use it, so DLM solutions
+# can be tested without a Redis server or an NFS share.
+#
+# Waiters for a lock are queued and the lock is granted to them in order as
+# soon as it is released, pushing the grant to the waiter instead of having
+# clients poll the lock.  Locks of members that stop sending heartbeats are
+# released once their lease expires, and so are the locks of connections that
+# are closed.
+
+from collections import defaultdict, deque
+import itertools as it
+import multiprocessing as mp
+from multiprocessing.connection import Client, Listener
+import os
+import threading
+import time
+import urlparse
+
+
+SCHEME = 'fifo'
+
+# Address of the running server, set on start so forked workers inherit it
+address = None
+
+LISTEN_BACKLOG = 1024
+
+LEASE_TIME = 10.0  # Seconds a member keeps its locks without heartbeats
+
+
+class _Lock(object):
+    def __init__(self):
+        self.holder = None  # (connection, member_id)
+        self.waiters = deque()  # (connection, member_id, request_id)
+
+
+class _State(object):
+    def __init__(self, lease_time):
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        self.locks = defaultdict(_Lock)
+        self.last_seen = {}  # Last time we heard from each member
+
+    def grant_next(self, name):
+        """Grant a lock to the first waiter that is still connected."""
+        lock = self.locks[name]
+        while lock.waiters:
+            conn, member_id, request_id = lock.waiters.popleft()
+            try:
+                conn.send((request_id, True))
+            except (IOError, EOFError):
+                continue
+            lock.holder = (conn, member_id)
+            return
+        del self.locks[name]
+
+    def acquire(self, conn, member_id, request_id, name, blocking):
+        lock = self.locks[name]
+        if not lock.holder:
+            lock.holder = (conn, member_id)
+            conn.send((request_id, True))
+        elif blocking:
+            # Reply will be sent when the lock is granted
+            lock.waiters.append((conn, member_id, request_id))
+        else:
+            conn.send((request_id, False))
+
+    def release(self, conn, request_id, name):
+        lock = self.locks.get(name)
+        released = bool(lock and lock.holder and lock.holder[0] is conn)
+        if released:
+            self.grant_next(name)
+        conn.send((request_id, released))
+
+    def disconnect(self, conn):
+        """Release locks of a connection and remove it from queues."""
+        for name, lock in self.locks.items():
+            lock.waiters = deque(w for w in lock.waiters if w[0] is not conn)
+            if lock.holder and lock.holder[0] is conn:
+                self.grant_next(name)
+            elif not lock.holder and not lock.waiters:
+                del self.locks[name]
+
+    def expire(self):
+        """Release locks of members whose lease has expired."""
+        deadline = time.time() - self.lease_time
+        for name, lock in self.locks.items():
+            if (lock.holder and
+                    self.last_seen.get(lock.holder[1], 0) < deadline):
+                self.grant_next(name)
+
+
+def _serve_client(conn, state):
+    member_id = None
+    try:
+        while True:
+            action, request_id, name, arg = conn.recv()
+            with state.lock:
+                if action == 'hello':
+                    member_id = name
+                state.last_seen[member_id] = time.time()
+
+                if action == 'acquire':
+                    state.acquire(conn, member_id, request_id, name, arg)
+                elif action == 'release':
+                    state.release(conn, request_id, name)
+                else:
+                    conn.send((request_id, True))
+    except (IOError, EOFError):
+        with state.lock:
+            state.disconnect(conn)
+        conn.close()
+
+
+def _expire(state):
+    while True:
+        time.sleep(state.lease_time / 4)
+        with state.lock:
+            state.expire()
+
+
+def _serve(listener, lease_time):
+    state = _State(lease_time)
+    t = threading.Thread(target=_expire, args=(state,))
+    t.daemon = True
+    t.start()
+    while True:
+        conn = listener.accept()
+        t = threading.Thread(target=_serve_client, args=(conn, state))
+        t.daemon = True
+        t.start()
+
+
+class LockServer(object):
+    """Process that grants locks to workers in the order they asked."""
+    def __init__(self, lease_time=LEASE_TIME):
+        self.lease_time = lease_time
+        self.process = None
+
+    def start(self):
+        global address
+        listener = Listener(('127.0.0.1', 0), backlog=LISTEN_BACKLOG,
+                            authkey=mp.current_process().authkey)
+        address = listener.address
+        self.process = mp.Process(target=_serve,
+                                  args=(listener, self.lease_time))
+        self.process.daemon = True
+        self.process.start()
+        listener.close()
+        return address
+
+    def stop(self):
+        global address
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        address = None
+
+
+def get_url():
+    """Return the URL of the running lock server for get_coordinator."""
+    if not address:
+        raise RuntimeError('Lock server is not running')
+    return '%s://%s:%s' % ((SCHEME,) + address)
+
+
+class FifoLock(object):
+    """Lock of the lock server, with the interface of tooz locks."""
+    def __init__(self, coordinator, name):
+        self.coordinator = coordinator
+        self.name = name
+
+    def acquire(self, blocking=True):
+        return self.coordinator._call('acquire', self.name, bool(blocking))
+
+    def release(self):
+        return self.coordinator._call('release', self.name)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+class FifoCoordinator(object):
+    """Coordinator for the lock server, with the interface of tooz's."""
+    def __init__(self, address, member_id):
+        self.address = address
+        self.member_id = member_id
+        self.ids = it.count()
+        self.local = threading.local()
+        self.connections = []
+
+    @property
+    def connection(self):
+        # Each process and thread needs its own connection to the server
+        conn = getattr(self.local, 'conn', None)
+        if not conn or self.local.pid != os.getpid():
+            conn = self.local.conn = Client(
+                self.address, authkey=mp.current_process().authkey)
+            self.local.pid = os.getpid()
+            self.connections.append(conn)
+            self._send(conn, 'hello', self.member_id)
+        return conn
+
+    def _send(self, conn, action, name=None, arg=None):
+        request_id = next(self.ids)
+        conn.send((action, request_id, name, arg))
+        # Replies come in the order of the requests of each connection
+        reply_id, result = conn.recv()
+        assert reply_id == request_id
+        return result
+
+    def _call(self, action, name=None, arg=None):
+        return self._send(self.connection, action, name, arg)
+
+    def start(self):
+        self.heartbeat()
+
+    def stop(self):
+        """Close all connections, which releases their locks."""
+        while self.connections:
+            self.connections.pop().close()
+
+    def heartbeat(self):
+        return self._call('heartbeat')
+
+    def get_lock(self, name):
+        return FifoLock(self, name)
+
+
+def get_coordinator(url, member_id):
+    """Return a coordinator for a lock server URL, ie: fifo://host:port."""
+    parsed = urlparse.urlparse(url)
+    return FifoCoordinator((parsed.hostname, parsed.port), member_id)
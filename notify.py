@@ -0,0 +1,170 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Wait and notify of volume status changes, used as a local stand-in for a
+# pub/sub service so waiters don't have to poll the DB.
+
+from collections import defaultdict
+import itertools as it
+import multiprocessing as mp
+from multiprocessing.connection import Client, Listener
+import os
+import threading
+import time
+
+
+# Address of the running broker, set on start so forked workers inherit it
+address = None
+
+LISTEN_BACKLOG = 1024
+
+WAIT_TIMEOUT = 0.5  # Seconds to wait for a notification before polling
+
+
+class Poller(object):
+    """Waiter that just sleeps, so callers have to poll for changes."""
+    notifies = False  # Whether waits finish when a change is published
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+
+    def wait(self, vol_id, status):
+        time.sleep(self.interval)
+        return False
+
+    def publish(self, vol_id, status):
+        pass
+
+
+class Notifier(object):
+    """Waiter that is woken up by the broker when a status is published.
+
+    Waits still finish after timeout seconds so a lost notification only
+    makes the caller fall back to polling.
+    """
+    notifies = True
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = WAIT_TIMEOUT if timeout is None else timeout
+        self.ids = it.count()
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        # Each process and thread needs its own connection to the broker
+        conn = getattr(self.local, 'conn', None)
+        if not conn or self.local.pid != os.getpid():
+            conn = self.local.conn = Client(
+                self.address, authkey=mp.current_process().authkey)
+            self.local.pid = os.getpid()
+        return conn
+
+    def wait(self, vol_id, status):
+        """Wait until vol_id is published with status, return if it was."""
+        conn = self.connection
+        wait_id = next(self.ids)
+        conn.send(('wait', wait_id, vol_id, status))
+
+        deadline = time.time() + self.timeout
+        remaining = self.timeout
+        while remaining > 0 and conn.poll(remaining):
+            # Ignore notifications for previous waits that timed out
+            if conn.recv() == wait_id:
+                return True
+            remaining = deadline - time.time()
+        return False
+
+    def publish(self, vol_id, status):
+        self.connection.send(('publish', None, vol_id, status))
+
+
+_notifier = None
+
+
+def get_notifier():
+    """Return this process' Notifier for the running broker."""
+    global _notifier
+    if not _notifier:
+        if not address:
+            raise RuntimeError('Notifications broker is not running')
+        _notifier = Notifier(address)
+    return _notifier
+
+
+def connect():
+    """Connect this thread to the broker before it waits or publishes."""
+    return get_notifier().connection
+
+
+def _serve_client(conn, lock, statuses, waiters):
+    try:
+        while True:
+            action, wait_id, vol_id, status = conn.recv()
+            with lock:
+                if action == 'publish':
+                    statuses[vol_id] = status
+                    for waiter, waiter_id in waiters.pop((vol_id, status),
+                                                         []):
+                        try:
+                            waiter.send(waiter_id)
+                        except (IOError, EOFError):
+                            pass
+                # Status may have been published before the waiter got here
+                elif statuses.get(vol_id) == status:
+                    conn.send(wait_id)
+                else:
+                    waiters[(vol_id, status)].append((conn, wait_id))
+    except (IOError, EOFError):
+        conn.close()
+
+
+def _serve(listener):
+    lock = threading.Lock()
+    statuses = {}
+    waiters = defaultdict(list)
+    while True:
+        conn = listener.accept()
+        t = threading.Thread(target=_serve_client,
+                             args=(conn, lock, statuses, waiters))
+        t.daemon = True
+        t.start()
+
+
+class Broker(object):
+    """Process that relays volume status changes to waiting workers."""
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        global address
+        # All workers connect at once, the default backlog of 1 makes the
+        # kernel drop connections that then hang on the handshake
+        listener = Listener(('127.0.0.1', 0), backlog=LISTEN_BACKLOG,
+                            authkey=mp.current_process().authkey)
+        address = listener.address
+        self.process = mp.Process(target=_serve, args=(listener,))
+        self.process.daemon = True
+        self.process.start()
+        listener.close()
+        return address
+
+    def stop(self):
+        global address
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        address = None
@@ -0,0 +1,319 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Simulated multi-master DB cluster to run the tests on a single box.
+#
+# Each node is a SQLite file and committed changes to volumes are written as
+# row based write-sets to a shared replication log.  Nodes apply write-sets
+# from other nodes in order once their replication lag has passed, which is
+# done lazily before any statement is run on the node, since that's the only
+# way to look at its data.  Like Galera, a transaction that changed a row
+# that has been changed on another node since the transaction started fails
+# certification on commit with a Deadlock error.  Transactions on the same
+# node are serialized, which is a coarser version of row locking.
+
+import itertools as it
+import json
+import os
+import random
+import re
+import sqlite3
+import time
+
+from sqlalchemy import create_engine as sa_create_engine
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+import db
+
+
+DATA_DIR = os.getcwd() + '/shared'
+REPLICATION_LAG = 0.005  # Mean seconds for a change to reach other nodes
+LOCK_WAIT_TIMEOUT = 50  # Like innodb_lock_wait_timeout
+
+DEADLOCK = (1213, 'Deadlock found when trying to get lock; try restarting '
+                  'transaction')
+LOCK_WAIT = (1205, 'Lock wait timeout exceeded; try restarting transaction')
+
+WRITE_STMT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.I)
+
+COLUMNS = tuple(c.name for c in db.Volume.__table__.columns)
+
+NODE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sim_state (applied_seq INTEGER NOT NULL,
+                                          applying INTEGER NOT NULL);
+    INSERT INTO sim_state SELECT 0, 0
+        WHERE NOT EXISTS (SELECT * FROM sim_state);
+    CREATE TABLE IF NOT EXISTS sim_changes (id TEXT NOT NULL);
+    CREATE TRIGGER IF NOT EXISTS sim_insert AFTER INSERT ON volumes
+        WHEN (SELECT applying FROM sim_state) = 0
+        BEGIN INSERT INTO sim_changes VALUES (NEW.id); END;
+    CREATE TRIGGER IF NOT EXISTS sim_update AFTER UPDATE ON volumes
+        WHEN (SELECT applying FROM sim_state) = 0
+        BEGIN INSERT INTO sim_changes VALUES (OLD.id);
+              INSERT INTO sim_changes VALUES (NEW.id); END;
+    CREATE TRIGGER IF NOT EXISTS sim_delete AFTER DELETE ON volumes
+        WHEN (SELECT applying FROM sim_state) = 0
+        BEGIN INSERT INTO sim_changes VALUES (OLD.id); END;
+"""
+
+LOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS writesets (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        node TEXT NOT NULL,
+        committed REAL NOT NULL,
+        id TEXT NOT NULL,
+        data TEXT);
+    CREATE INDEX IF NOT EXISTS writesets_id ON writesets (id, seq);
+"""
+
+
+class OperationalError(Exception):
+    """Stand-in for the DBAPI errors MySQL would raise."""
+
+
+def _error(error, statement=None, params=None):
+    return exc.OperationalError(statement, params, OperationalError(*error))
+
+
+def _path(db_name, node):
+    return os.path.join(DATA_DIR, 'sim_%s_%s.db' % (db_name, node))
+
+
+def _log_path(db_name):
+    return os.path.join(DATA_DIR, 'sim_%s_log.db' % db_name)
+
+
+def _connect(path, factory=sqlite3.Connection):
+    conn = sqlite3.connect(path, timeout=LOCK_WAIT_TIMEOUT,
+                           isolation_level=None, check_same_thread=False,
+                           factory=factory)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def _execute(conn, statement, params=()):
+    """Run a statement translating locked databases to lock wait timeouts."""
+    try:
+        return conn.execute(statement, params)
+    except sqlite3.OperationalError as e:
+        if 'locked' in str(e):
+            raise _error(LOCK_WAIT, statement, params)
+        raise
+
+
+class NodeConnection(sqlite3.Connection):
+    """Connection to a node that keeps track of replication."""
+    def setup(self, node, db_name):
+        self.node = node
+        self.log = _connect(_log_path(db_name))
+        # Applied sequence when the current transaction started
+        self.txn_seq = None
+
+    def _applied_seq(self):
+        return self.execute('SELECT applied_seq FROM sim_state').fetchone()[0]
+
+    def _apply(self):
+        """Apply due write-sets from other nodes, must be in a transaction."""
+        applied = initial = self._applied_seq()
+        now = time.time()
+        for seq, node, committed, vol_id, data in self.log.execute(
+                'SELECT seq, node, committed, id, data FROM writesets '
+                'WHERE seq > ? ORDER BY seq', (applied,)).fetchall():
+            if node != self.node:
+                lag = random.Random((seq, self.node)).expovariate(
+                    1.0 / REPLICATION_LAG)
+                # Write-sets are applied in order
+                if committed + lag > now:
+                    break
+                self._apply_writeset(vol_id, data)
+            applied = seq
+
+        if applied != initial:
+            self.execute('UPDATE sim_state SET applied_seq = ?, applying = 0',
+                         (applied,))
+        return applied
+
+    def _apply_writeset(self, vol_id, data):
+        self.execute('UPDATE sim_state SET applying = 1')
+        if data is None:
+            self.execute('DELETE FROM volumes WHERE id = ?', (vol_id,))
+        else:
+            data = json.loads(data)
+            self.execute('INSERT OR REPLACE INTO volumes (%s) VALUES (%s)' %
+                         (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                         [data[c] for c in COLUMNS])
+
+    def begin(self):
+        _execute(self, 'BEGIN IMMEDIATE')
+        self.txn_seq = self._apply()
+
+    def catch_up(self):
+        """Apply due write-sets outside of a transaction."""
+        pending = self.log.execute(
+            'SELECT 1 FROM writesets WHERE seq > ? AND node != ? LIMIT 1',
+            (self._applied_seq(), self.node)).fetchone()
+        if pending:
+            self.begin()
+            self.commit_txn()
+
+    def commit_txn(self):
+        """Certify the transaction against other nodes' changes and commit.
+
+        Raises a Deadlock error if the transaction fails certification.
+        """
+        if self.txn_seq is None:
+            return
+
+        try:
+            ids = [row[0] for row in
+                   self.execute('SELECT DISTINCT id FROM sim_changes')]
+            if ids:
+                self._certify(ids)
+                self.execute('DELETE FROM sim_changes')
+            _execute(self, 'COMMIT')
+        except Exception:
+            self.rollback_txn()
+            raise
+        self.txn_seq = None
+
+    def _certify(self, ids):
+        _execute(self.log, 'BEGIN IMMEDIATE')
+        try:
+            # SQLite limits the number of parameters in a statement
+            for i in xrange(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                conflict = self.log.execute(
+                    'SELECT 1 FROM writesets WHERE seq > ? AND node != ? AND '
+                    'id IN (%s) LIMIT 1' % ', '.join('?' * len(chunk)),
+                    [self.txn_seq, self.node] + chunk).fetchone()
+                if conflict:
+                    raise _error(DEADLOCK)
+
+            now = time.time()
+            for vol_id in ids:
+                row = self.execute('SELECT %s FROM volumes WHERE id = ?' %
+                                   ', '.join(COLUMNS), (vol_id,)).fetchone()
+                data = json.dumps(dict(zip(COLUMNS, row))) if row else None
+                self.log.execute('INSERT INTO writesets (node, committed, '
+                                 'id, data) VALUES (?, ?, ?, ?)',
+                                 (self.node, now, vol_id, data))
+            _execute(self.log, 'COMMIT')
+        except Exception:
+            self.log.execute('ROLLBACK')
+            raise
+
+    def rollback_txn(self):
+        if self.txn_seq is not None:
+            self.execute('ROLLBACK')
+            self.txn_seq = None
+
+
+_initialized = set()
+
+
+def init_cluster(nodes_ips, db_name):
+    """Create the replication log and nodes' files with their schema."""
+    if (tuple(nodes_ips), db_name) in _initialized:
+        return
+    _initialized.add((tuple(nodes_ips), db_name))
+
+    if not os.path.isdir(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    _connect(_log_path(db_name)).executescript(LOG_SCHEMA)
+    for node in nodes_ips:
+        engine = sa_create_engine('sqlite:///' + _path(db_name, node))
+        db.Base.metadata.create_all(engine)
+        engine.dispose()
+        _connect(_path(db_name, node)).executescript(NODE_SCHEMA)
+
+
+def reset_cluster(nodes_ips, db_name):
+    """Remove all data from the cluster."""
+    for path in ([_log_path(db_name)] +
+                 [_path(db_name, node) for node in nodes_ips]):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    _initialized.discard((tuple(nodes_ips), db_name))
+    init_cluster(nodes_ips, db_name)
+
+
+def _raw(conn):
+    return conn.connection.connection
+
+
+def _on_begin(conn):
+    _raw(conn).begin()
+
+
+def _on_commit(conn):
+    _raw(conn).commit_txn()
+
+
+def _on_rollback(conn):
+    _raw(conn).rollback_txn()
+
+
+def _on_reset(dbapi_conn, record):
+    # Connection returned to the pool in the middle of a transaction
+    dbapi_conn.rollback_txn()
+
+
+def _before_execute(conn, cursor, statement, params, context, executemany):
+    raw = _raw(conn)
+    if raw.txn_seq is None:
+        # Writes outside of transactions will be autocommitted by SQLAlchemy
+        if WRITE_STMT.match(statement):
+            raw.begin()
+        else:
+            raw.catch_up()
+
+
+def _on_error(context):
+    e = context.original_exception
+    if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+        raise _error(LOCK_WAIT, context.statement, context.parameters)
+
+
+def create_engine(ip, nodes_ips, db_name, **engine_args):
+    """Return an engine for a node, or a round robin router if ip is not one.
+
+    Like HAProxy in roundrobin mode each new connection to the router goes
+    to the next node.
+    """
+    if ip in nodes_ips:
+        nodes = it.repeat(ip)
+    else:
+        nodes = it.islice(it.cycle(nodes_ips), os.getpid() % len(nodes_ips),
+                          None)
+
+    def creator():
+        node = next(nodes)
+        conn = _connect(_path(db_name, node), NodeConnection)
+        conn.setup(node, db_name)
+        return conn
+
+    init_cluster(nodes_ips, db_name)
+    engine = sa_create_engine('sqlite://', creator=creator,
+                              poolclass=QueuePool, **engine_args)
+    event.listen(engine, 'begin', _on_begin)
+    event.listen(engine, 'commit', _on_commit)
+    event.listen(engine, 'rollback', _on_rollback)
+    event.listen(engine, 'reset', _on_reset)
+    event.listen(engine, 'before_cursor_execute', _before_execute)
+    event.listen(engine, 'handle_error', _on_error)
+    return engine
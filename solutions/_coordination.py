@@ -0,0 +1,177 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Tooz coordinators and locks shared by the tooz solutions.
+#
+# There is one coordinator per backend URL in each process, and each thread
+# keeps the locks it has used in an LRU cache, so workers changing many
+# volumes don't create a lock every time or use the lock of another volume.
+# Coordinators heartbeat on a background thread, so locks are not lost while
+# workers are busy with the DB or doing the operation.  Besides tooz's
+# backends we can use the local lock server (lockserver.py), which doesn't
+# need tooz.
+
+from collections import OrderedDict
+import os
+import socket
+import threading
+import time
+
+try:
+    from tooz import coordination
+except ImportError:
+    coordination = None
+
+import lockserver
+
+LOCK_CACHE_SIZE = 1000  # Locks to keep in each thread for each URL
+HEARTBEAT_INTERVAL = 1.0  # Seconds between coordinator heartbeats
+
+_coordinators = {}
+_coordinators_pid = None
+_coordinators_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_driver(url, member_id):
+    """Return a tooz coordinator, or our lock server's for its URLs."""
+    if url.startswith(lockserver.SCHEME + '://'):
+        return lockserver.get_coordinator(url, member_id)
+    return coordination.get_coordinator(url, member_id)
+
+
+class ManagedCoordinator(object):
+    """Tooz coordinator that heartbeats on a background thread.
+
+    Heartbeats that fail or that are late by a whole interval, for example
+    because the process was too busy, are counted as missed.
+    """
+    def __init__(self, url, member_id, interval=HEARTBEAT_INTERVAL):
+        self.coordinator = _get_driver(url, member_id)
+        self.interval = interval
+        self.missed = 0
+        self.last_heartbeat = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self.coordinator.start()
+        self.last_heartbeat = time.time()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.coordinator.stop()
+
+    def get_lock(self, name):
+        return self.coordinator.get_lock(name)
+
+    def heartbeat(self):
+        now = time.time()
+        try:
+            self.coordinator.heartbeat()
+        except Exception:
+            self.missed += 1
+            return
+        late = now - self.last_heartbeat - self.interval
+        if late >= self.interval:
+            self.missed += int(late / self.interval)
+        self.last_heartbeat = now
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.heartbeat()
+
+
+def get_coordinator(url):
+    """Return this process' started coordinator for a backend URL."""
+    global _coordinators_pid
+    with _coordinators_lock:
+        # Coordinators from the parent process cannot be used
+        if _coordinators_pid != os.getpid():
+            _coordinators.clear()
+            _coordinators_pid = os.getpid()
+
+        coordinator = _coordinators.get(url)
+        if not coordinator:
+            member_id = '%s-%s' % (socket.gethostname(), os.getpid())
+            coordinator = ManagedCoordinator(url, member_id,
+                                             HEARTBEAT_INTERVAL)
+            coordinator.start()
+            _coordinators[url] = coordinator
+        return coordinator
+
+
+class LockCache(object):
+    """LRU cache of a coordinator's locks keyed by name."""
+    def __init__(self, coordinator, size=LOCK_CACHE_SIZE):
+        self.coordinator = coordinator
+        self.size = size
+        self.locks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self.locks
+
+    def get(self, name):
+        lock = self.locks.pop(name, None)
+        if lock:
+            self.hits += 1
+        else:
+            self.misses += 1
+            # Evicted locks that are held can still be released by whoever
+            # has them
+            if len(self.locks) >= self.size:
+                self.locks.popitem(last=False)
+                self.evictions += 1
+            lock = self.coordinator.get_lock(name)
+        # Most recently used locks are at the end
+        self.locks[name] = lock
+        return lock
+
+
+def get_locks(url):
+    """Return this thread's lock cache for a backend URL."""
+    coordinator = get_coordinator(url)
+    caches = getattr(_local, 'caches', None)
+    if caches is None or _local.pid != os.getpid():
+        caches = _local.caches = {}
+        _local.pid = os.getpid()
+
+    locks = caches.get(url)
+    if not locks or locks.coordinator is not coordinator:
+        locks = caches[url] = LockCache(coordinator, LOCK_CACHE_SIZE)
+    return locks
+
+
+def get_lock(url, name):
+    """Return the lock for name and the cache counters to report."""
+    locks = get_locks(url)
+    counter = 'lock_hits' if name in locks else 'lock_misses'
+    return locks.get(name), {counter: 1}
+
+
+def warm_up(url):
+    """Start the coordinator for a backend URL and use it from this thread.
+
+    Backends like our lock server connect each thread on first use.
+    """
+    coordinator = get_coordinator(url)
+    coordinator.coordinator.heartbeat()
+    get_locks(url)
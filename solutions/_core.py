@@ -0,0 +1,52 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Status changes with Core statements that are built once and whose compiled
+# form is cached, so we can compare them with building them on every call.
+
+from sqlalchemy import and_, bindparam, select
+
+import db
+
+volumes = db.Volume.__table__
+
+# Compiled statements for all connections in this process
+compiled_cache = {}
+
+# Parameters can't have the name of the columns being updated
+UPDATE_STATUS = volumes.update().where(and_(
+    volumes.c.id == bindparam('vol_id'),
+    volumes.c.status == bindparam('initial'))).values(
+        status=bindparam('destination'),
+        attach_status=bindparam('marker'))
+
+SELECT_STATUS_FOR_UPDATE = select([volumes.c.status]).where(
+    volumes.c.id == bindparam('vol_id')).with_for_update()
+
+
+def execute(conn, statement, **params):
+    return conn.execution_options(compiled_cache=compiled_cache).execute(
+        statement, **params)
+
+
+def update_status(conn, vol_id, initial, destination, attach_status):
+    """Change status of a volume if it's initial, return rows changed."""
+    return execute(conn, UPDATE_STATUS, vol_id=vol_id, initial=initial,
+                   destination=destination, marker=attach_status).rowcount
+
+
+def get_status_for_update(conn, vol_id):
+    """Return the status of a volume locking its row."""
+    return execute(conn, SELECT_STATUS_FOR_UPDATE, vol_id=vol_id).scalar()
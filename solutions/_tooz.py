@@ -14,38 +14,41 @@
 #    limitations under the License.
 
 import db
-import time
-from tooz import coordination
+import instrument
+import notify
+from solutions import _coordination
 
 
 session_cfg = {'autocommit': True, 'expire_on_commit': True}
 
-coordinator = None
-lock = None
+poller = notify.Poller(0.01)
 
 
 @db.retry_on_operational_error
-def tooz_make_change(driver, url, session, vol_id, initial, destination,
-                     attach_status):
-    global coordinator
-    global lock
-
-    # If coordinator is not the one we want we cannot reuse it
-    if not isinstance(coordinator, driver):
-        if coordinator:
-            coordinator.stop()
-
-        # Create new coordinator and lock
-        coordinator = coordination.get_coordinator(url, str(session))
-        coordinator.start()
-        lock = coordinator.get_lock(vol_id)
+def tooz_make_change(url, session, vol_id, initial, destination,
+                     attach_status, waiter=poller):
+    coordinator = _coordination.get_coordinator(url)
+    missed = coordinator.missed
+    lock, counters = _coordination.get_lock(url, vol_id)
 
+    polls = 0
     while True:
-        with lock, session.begin():
-            vol = session.query(db.Volume).with_for_update().get(vol_id)
-            if vol.status == initial:
-                vol.status = destination
-                vol.attach_status = attach_status
-                return
-        coordinator.heartbeat()
-        time.sleep(0.01)
+        with instrument.timer('lock_wait'):
+            lock.acquire()
+        try:
+            with session.begin():
+                vol = session.query(db.Volume).with_for_update().get(vol_id)
+                changed = vol.status == initial
+                if changed:
+                    vol.status = destination
+                    vol.attach_status = attach_status
+        finally:
+            lock.release()
+
+        if changed:
+            waiter.publish(vol_id, destination)
+            counters['polls'] = polls
+            counters['missed_heartbeats'] = coordinator.missed - missed
+            return counters
+        polls += 1
+        waiter.wait(vol_id, initial)
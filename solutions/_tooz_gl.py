@@ -13,19 +13,28 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-import time
+import threading
 
 from sqlalchemy import and_
-from tooz import coordination
 
 import db
+import instrument
+import notify
+from solutions import _coordination
 
 
 session_cfg = {'autocommit': True, 'expire_on_commit': True}
 
-coordinator = None
-lock = None
-acquired = False
+# Locks each thread holds between calls, by volume id
+_local = threading.local()
+
+poller = notify.Poller(0.01)
+
+
+def _acquired():
+    if not hasattr(_local, 'locks'):
+        _local.locks = {}
+    return _local.locks
 
 
 # Code extracted from https://review.openstack.org/#/c/109837/
@@ -44,30 +53,24 @@ def safe_update(session, instance_id, values, expected_values):
 
 
 @db.retry_on_operational_error
-def tooz_make_change(driver, url, session, vol_id, initial, destination,
-                     attach_status):
-    global coordinator
-    global lock
-    global acquired
-
-    # If coordinator is not the one we want we cannot reuse it
-    if not isinstance(coordinator, driver):
-        if coordinator:
-            coordinator.stop()
-
-        # Create new coordinator and lock
-        coordinator = coordination.get_coordinator(url, str(session))
-        coordinator.start()
-        lock = coordinator.get_lock(vol_id)
+def tooz_make_change(url, session, vol_id, initial, destination,
+                     attach_status, waiter=poller):
+    coordinator = _coordination.get_coordinator(url)
+    missed = coordinator.missed
+    lock, counters = _coordination.get_lock(url, vol_id)
+    acquired = _acquired()
 
     # When going from available to any other state we acquire the lock
+    polls = 0
     if initial == 'available':
-        # If this is a retry we've already acquired the lock
-        if not acquired:
-            while not lock.acquire():
-                coordinator.heartbeat()
-                time.sleep(0.01)
-            acquired = True
+        # If this is a retry we've already acquired the lock, and if we are
+        # notified on releases there's no need for tooz to poll the lock.
+        if vol_id not in acquired:
+            with instrument.timer('lock_wait'):
+                while not lock.acquire(blocking=not waiter.notifies):
+                    polls += 1
+                    waiter.wait(vol_id, 'available')
+            acquired[vol_id] = lock
 
     n = 0
     while n == 0:
@@ -75,7 +78,10 @@ def tooz_make_change(driver, url, session, vol_id, initial, destination,
                         {'status': destination,
                          'attach_status': attach_status},
                         {'status': initial})
-    coordinator.heartbeat()
     if destination == 'available':
-        lock.release()
-        acquired = False
+        # The lock may have been evicted from the cache while we had it
+        acquired.pop(vol_id, lock).release()
+    waiter.publish(vol_id, destination)
+    counters['polls'] = polls
+    counters['missed_heartbeats'] = coordinator.missed - missed
+    return counters
@@ -0,0 +1,129 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Compare and Swap while there are few conflicts on a volume, and a DLM to
+# serialize changes when many workers are fighting for it.
+#
+# Conflicts when acquiring a volume (times it didn't have the expected status,
+# deadlocks, timeouts and, with the DLM, finding the lock taken) are tracked
+# per volume in each process with an exponentially weighted moving average,
+# and changes switch to the DLM when it goes above DLM_THRESHOLD and back to
+# Compare and Swap when it goes below CAS_THRESHOLD.  Releases don't count,
+# as the worker already owns the volume they never conflict.  The DLM path
+# still makes the change with Compare and Swap, so workers that disagree on
+# the path to use can't break atomicity.
+
+import logging
+import threading
+
+import db
+import instrument
+import lockserver
+import notify
+from solutions import _coordination
+from solutions import update_with_where
+
+session_cfg = update_with_where.session_cfg
+
+poller = notify.Poller(0.01)
+
+# Tooz URL of the DLM, None for the local lock server
+DLM_URL = None
+
+WEIGHT = 0.3  # Weight of the last acquire in the conflict rate
+DLM_THRESHOLD = 1.0  # Conflicts per acquire to start using the DLM
+CAS_THRESHOLD = 0.25  # Conflicts per acquire to go back to Compare and Swap
+
+LOG = logging
+
+_lock = threading.Lock()
+_rates = {}  # Conflict rate of each volume
+_dlm_volumes = set()  # Volumes changed with the DLM
+
+
+def _update_rate(vol_id, conflicts):
+    """Update the conflict rate of a volume, return if we switched paths."""
+    with _lock:
+        rate = _rates[vol_id] = (WEIGHT * conflicts +
+                                 (1 - WEIGHT) * _rates.get(vol_id, 0.0))
+        if vol_id in _dlm_volumes:
+            if rate < CAS_THRESHOLD:
+                _dlm_volumes.discard(vol_id)
+                LOG.info('Volume %s switching to CAS, %.2f conflicts per '
+                         'acquire', vol_id, rate)
+                return True
+        elif rate > DLM_THRESHOLD:
+            _dlm_volumes.add(vol_id)
+            LOG.info('Volume %s switching to DLM, %.2f conflicts per '
+                     'acquire', vol_id, rate)
+            return True
+    return False
+
+
+def _dlm_url():
+    return DLM_URL or lockserver.get_url()
+
+
+def warm_up():
+    _coordination.warm_up(_dlm_url())
+
+
+@db.retry_on_operational_error
+def dlm_change(session, vol_id, initial, destination, attach_status,
+               waiter=poller):
+    """Change the volume with Compare and Swap holding its DLM lock."""
+    lock, counters = _coordination.get_lock(_dlm_url(), vol_id)
+    counters['contended'] = 0
+    polls = 0
+    while True:
+        if not lock.acquire(blocking=False):
+            counters['contended'] += 1
+            with instrument.timer('lock_wait'):
+                lock.acquire()
+        try:
+            n = update_with_where.safe_update(
+                session, vol_id,
+                {'status': destination, 'attach_status': attach_status},
+                {'status': initial})
+        finally:
+            lock.release()
+
+        if n != 0:
+            waiter.publish(vol_id, destination)
+            counters['polls'] = polls
+            return counters
+        # Don't hold the lock while the volume is changed to initial
+        polls += 1
+        waiter.wait(vol_id, initial)
+
+
+def make_change(session, vol_id, initial, destination, attach_status,
+                waiter=poller):
+    use_dlm = vol_id in _dlm_volumes
+    if use_dlm:
+        result = dlm_change(session, vol_id, initial, destination,
+                            attach_status, waiter=waiter)
+    else:
+        result = update_with_where.make_change(
+            session, vol_id, initial, destination, attach_status,
+            waiter=waiter)
+
+    conflicts = (result.get('polls', 0) + result['deadlocks'] +
+                 result['timeouts'] + result.pop('contended', 0))
+    # Only acquires tell us how contended the volume is
+    switched = initial == 'available' and _update_rate(vol_id, conflicts)
+    result['switches'] = int(switched)
+    result['dlm_changes'] = int(use_dlm)
+    return result
@@ -0,0 +1,116 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Compare and Swap of many volumes with a single UPDATE, like group
+# operations would do.
+
+from collections import defaultdict
+
+import db
+import notify
+from sqlalchemy import and_, select
+
+session_cfg = {'autocommit': True, 'expire_on_commit': True}
+
+poller = notify.Poller(0.01)
+
+# Partial acquisitions to retry before releasing the volumes we already have
+# so workers holding part of the same batch don't wait for each other forever
+HOLD_ATTEMPTS = 10
+
+
+def batch_update(conn, vol_ids, values, expected_values):
+    """Update all volumes that have the expected values in one statement.
+
+    Returns the number of volumes that were updated.
+    """
+    vol_tab = db.Volume.__table__
+    where_conds = [vol_tab.c.id.in_(vol_ids)]
+    for field, value in expected_values.items():
+        where_conds.append(vol_tab.c[field] == value)
+    upd_stmt = vol_tab.update().where(and_(*where_conds)).values(**values)
+    return conn.execute(upd_stmt).rowcount
+
+
+def select_ids(conn, vol_ids, values):
+    """Return the set of ids from vol_ids that have all values."""
+    vol_tab = db.Volume.__table__
+    where_conds = [vol_tab.c.id.in_(vol_ids)]
+    for field, value in values.items():
+        where_conds.append(vol_tab.c[field] == value)
+    return {row[0] for row in
+            conn.execute(select([vol_tab.c.id]).where(and_(*where_conds)))}
+
+
+@db.retry_on_operational_error
+def update_batch(session, vol_ids, values, expected_values, changed):
+    """Update volumes and add the ones that were updated to changed.
+
+    The update and the check of which volumes were updated are done in the
+    same transaction so nobody can change them in between, and changed is
+    only modified once the transaction has been committed.
+    """
+    with session.begin():
+        conn = session.connection()
+        batch_update(conn, vol_ids, values, expected_values)
+        updated = select_ids(conn, vol_ids, values)
+    changed.update(updated)
+
+
+def make_batch_change(session, vol_ids, initial, destination, attach_status,
+                      waiter=poller):
+    """Change all vol_ids from initial to destination status.
+
+    Only volumes we haven't changed yet are retried.  If we can't get all of
+    them in HOLD_ATTEMPTS tries we give back the ones we have, restoring only
+    their status, and start over.
+    """
+    vol_ids = set(vol_ids)
+    new_values = {'status': destination, 'attach_status': attach_status}
+    result = defaultdict(int)
+    changed = set()
+    attempts = 0
+    while True:
+        r = update_batch(session, vol_ids - changed, new_values,
+                         {'status': initial}, changed)
+        for k, v in r.iteritems():
+            result[k] += v
+
+        if changed == vol_ids:
+            for vol_id in changed:
+                waiter.publish(vol_id, destination)
+            return result
+
+        result['polls'] += 1
+        attempts += 1
+        if changed and attempts >= HOLD_ATTEMPTS:
+            # Only the status is given back, attach_status keeps our marker
+            # as we don't know what it was, and whoever gets the volume next
+            # will set theirs.
+            r = update_batch(session, set(changed), {'status': initial},
+                             new_values, set())
+            for k, v in r.iteritems():
+                result[k] += v
+            for vol_id in changed:
+                waiter.publish(vol_id, initial)
+            changed.clear()
+            attempts = 0
+        waiter.wait(next(iter(vol_ids - changed)), initial)
+
+
+def make_change(session, vol_id, initial, destination, attach_status,
+                waiter=poller):
+    return make_batch_change(session, (vol_id,), initial, destination,
+                             attach_status, waiter=waiter)
@@ -14,18 +14,27 @@
 #    limitations under the License.
 
 import db
-import time
+import notify
 
 session_cfg = {'autocommit': True, 'expire_on_commit': True}
 
+poller = notify.Poller(0.01)
+
 
 @db.retry_on_operational_error
-def make_change(session, vol_id, initial, destination, attach_status):
+def make_change(session, vol_id, initial, destination, attach_status,
+                waiter=poller):
+    polls = 0
     while True:
         with session.begin():
             vol = session.query(db.Volume).with_for_update().get(vol_id)
-            if vol.status == initial:
+            changed = vol.status == initial
+            if changed:
                 vol.status = destination
                 vol.attach_status = attach_status
-                return
-        time.sleep(0.01)
+
+        if changed:
+            waiter.publish(vol_id, destination)
+            return {'polls': polls}
+        polls += 1
+        waiter.wait(vol_id, initial)
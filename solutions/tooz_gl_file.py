@@ -15,12 +15,19 @@
 
 import os
 
+from solutions import _coordination
 from solutions import _tooz_gl as tz
-from tooz.drivers.file import FileDriver
 
 session_cfg = tz.session_cfg
 
 
+def _url():
+    return 'file://' + os.getcwd() + '/shared'
+
+
+def warm_up():
+    _coordination.warm_up(_url())
+
+
 def make_change(session, *args, **kwargs):
-    url = 'file://' + os.getcwd() + '/shared'
-    return tz.tooz_make_change(FileDriver, url, session, *args, **kwargs)
+    return tz.tooz_make_change(_url(), session, *args, **kwargs)
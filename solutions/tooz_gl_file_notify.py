@@ -0,0 +1,36 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+
+import notify
+from solutions import _coordination
+from solutions import _tooz_gl as tz
+
+session_cfg = tz.session_cfg
+
+
+def _url():
+    return 'file://' + os.getcwd() + '/shared'
+
+
+def warm_up():
+    _coordination.warm_up(_url())
+    notify.connect()
+
+
+def make_change(session, *args, **kwargs):
+    return tz.tooz_make_change(_url(), session, *args,
+                               waiter=notify.get_notifier(), **kwargs)
@@ -13,12 +13,17 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+from solutions import _coordination
 from solutions import _tooz_gl as tz
-from tooz.drivers.file import FileDriver
 
 session_cfg = tz.session_cfg
 
+URL = 'redis://192.168.1.14'
+
+
+def warm_up():
+    _coordination.warm_up(URL)
+
 
 def make_change(session, *args, **kwargs):
-    url = 'redis://192.168.1.14'
-    return tz.tooz_make_change(FileDriver, url, session, *args, **kwargs)
+    return tz.tooz_make_change(URL, session, *args, **kwargs)
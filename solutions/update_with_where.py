@@ -14,11 +14,13 @@
 #    limitations under the License.
 
 import db
-import time
+import notify
 from sqlalchemy import and_
 
 session_cfg = {'autocommit': True, 'expire_on_commit': True}
 
+poller = notify.Poller(0.01)
+
 
 # Code extracted from https://review.openstack.org/#/c/109837/
 def safe_update(session, instance_id, values, expected_values):
@@ -59,13 +61,16 @@ def safe_update(session, instance_id, values, expected_values):
 
 
 @db.retry_on_operational_error
-def make_change(session, vol_id, initial, destination, attach_status):
-    n = 0
+def make_change(session, vol_id, initial, destination, attach_status,
+                waiter=poller):
+    polls = 0
     while True:
         n = safe_update(
             session, vol_id,
             {'status': destination, 'attach_status': attach_status},
             {'status': initial})
         if n != 0:
-            return
-        time.sleep(0.01)
+            waiter.publish(vol_id, destination)
+            return {'polls': polls}
+        polls += 1
+        waiter.wait(vol_id, initial)
@@ -0,0 +1,40 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import db
+import notify
+from solutions import _core
+
+session_cfg = {'autocommit': True, 'expire_on_commit': True}
+
+poller = notify.Poller(0.01)
+
+
+@db.retry_on_operational_error
+def make_change(session, vol_id, initial, destination, attach_status,
+                waiter=poller):
+    polls = 0
+    while True:
+        conn = session.connection()
+        try:
+            n = _core.update_status(conn, vol_id, initial, destination,
+                                    attach_status)
+        finally:
+            conn.close()
+        if n != 0:
+            waiter.publish(vol_id, destination)
+            return {'polls': polls}
+        polls += 1
+        waiter.wait(vol_id, initial)
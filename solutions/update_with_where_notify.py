@@ -0,0 +1,29 @@
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import notify
+from solutions import update_with_where
+
+session_cfg = update_with_where.session_cfg
+
+
+def warm_up():
+    notify.connect()
+
+
+def make_change(session, *args, **kwargs):
+    waiter = notify.get_notifier()
+    return update_with_where.make_change(session, *args, waiter=waiter,
+                                         **kwargs)
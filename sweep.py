@@ -0,0 +1,203 @@
+#!/bin/env python
+
+# Copyright 2015 Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Run the tests for every combination of the settings below, so whole scaling
+# curves can be produced unattended.  Results of each combination are stored
+# in SWEEP_DIR under a hash of its configuration, so rerunning the sweep skips
+# the ones that have already been run and resumes where it stopped.
+
+import hashlib
+import itertools as it
+import json
+import os
+import time
+import types
+
+import archive
+import db
+import ha_test
+import lockserver
+import notify
+import simcluster
+import test_results
+
+ROWS = (100, 400)  # Number of rows
+WORKERS_PER_ROW = (1, 3, 5)  # Workers fighting for each row
+
+# Synthetic workload generators as (generators, selects, updates per second)
+WORKLOADS = ((50, 10, 5),)
+
+# Names of the solutions to test, ie: ('forupdate', 'update_with_where'),
+# None for all of them
+SOLUTIONS = None
+
+SWEEP_DIR = os.getcwd() + '/sweep'
+OUTPUT_FILE = os.getcwd() + '/sweep.csv'
+
+# Configuration keys written to OUTPUT_FILE before the results
+CONFIG_COLUMNS = ('rows', 'workers_per_row', 'syn_generators', 'syn_selects',
+                  'syn_updates')
+
+
+def solution_settings(solution):
+    """Return settings of a solution and of the solution modules it uses."""
+    result = {}
+    seen = set()
+    pending = [solution]
+    while pending:
+        module = pending.pop()
+        if module.__name__ in seen:
+            continue
+        seen.add(module.__name__)
+        prefix = module.__name__.split('.')[-1]
+        for name, value in vars(module).iteritems():
+            if isinstance(value, types.ModuleType):
+                if value.__name__.startswith('solutions.'):
+                    pending.append(value)
+                continue
+            if not name.isupper():
+                continue
+            # Statements and the like are not settings
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            result['%s.%s' % (prefix, name)] = value
+    return result
+
+
+def get_config(solution, rows, workers_per_row, workload):
+    """Return everything in ha_test's configuration that affects results."""
+    syn_generators, syn_selects, syn_updates = workload
+    config = {'solution': solution.__name__.split('.')[-1],
+              'rows': rows,
+              'workers_per_row': workers_per_row,
+              'syn_generators': syn_generators,
+              'syn_selects': syn_selects,
+              'syn_updates': syn_updates,
+              'syn_open_loop': ha_test.SYN_DB_OPEN_LOOP,
+              'syn_generators_per_process':
+                  ha_test.SYN_DB_GENERATORS_PER_PROCESS,
+              'table_rows': ha_test.TABLE_ROWS,
+              'num_tests': ha_test.NUM_TESTS_PER_WORKER,
+              'delete_time': ha_test.DELETE_TIME,
+              'batch_size': ha_test.BATCH_SIZE,
+              'workers_per_process': ha_test.WORKERS_PER_PROCESS,
+              'measure_lag': ha_test.MEASURE_LAG,
+              'lag_poll_interval': ha_test.LAG_POLL_INTERVAL,
+              'instrument_phases': ha_test.INSTRUMENT_PHASES,
+              'retry_policy': repr(getattr(solution, 'retry_policy',
+                                           ha_test.RETRY_POLICY)),
+              'solution_settings': solution_settings(solution),
+              'lease_time': lockserver.LEASE_TIME,
+              'notify_timeout': notify.WAIT_TIMEOUT,
+              'backend': ha_test.DB_BACKEND,
+              'nodes': list(ha_test.DB_NODES)}
+    if ha_test.DB_BACKEND == 'sim':
+        config['replication_lag'] = simcluster.REPLICATION_LAG
+        config['lock_wait_timeout'] = simcluster.LOCK_WAIT_TIMEOUT
+    return config
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()[:16]
+
+
+def load_summary(path):
+    """Return the configuration and summary stored in path."""
+    with open(path) as f:
+        data = json.load(f)
+    return data['config'], test_results.Summary(**data['summary'])
+
+
+def save_summary(path, config, summary):
+    """Store configuration and summary of a run in path."""
+    # Write to a temporary file first so an interrupted sweep doesn't leave
+    # a partial result that would be skipped on resume
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'config': config, 'summary': summary.__dict__}, f,
+                  sort_keys=True, indent=1)
+    os.rename(path + '.tmp', path)
+
+
+def main():
+    solutions = ha_test.get_solutions()
+    if SOLUTIONS is not None:
+        solutions = [s for s in solutions
+                     if s.__name__.split('.')[-1] in SOLUTIONS]
+
+    if not os.path.isdir(SWEEP_DIR):
+        os.makedirs(SWEEP_DIR)
+
+    db_data = ha_test.get_db_data()
+    broker = notify.Broker()
+    broker.start()
+    lock_server = lockserver.LockServer()
+    lock_server.start()
+
+    configs = []
+    summaries = []
+    try:
+        for rows in ROWS:
+            uuids = None
+            for workload, workers_per_row, solution in it.product(
+                    WORKLOADS, WORKERS_PER_ROW, solutions):
+                config = get_config(solution, rows, workers_per_row,
+                                    workload)
+                name = config_hash(config)
+                path = os.path.join(SWEEP_DIR, name + '.json')
+                if os.path.exists(path):
+                    print 'Skipping %s, already in %s' % (config, path)
+                    config, summary = load_summary(path)
+                else:
+                    # Only populate the database if we are running something
+                    if uuids is None:
+                        uuids = db.populate_database(
+                            db_data, rows, ha_test.TABLE_ROWS)
+                    store = test_results.ResultStore()
+                    started = time.time()
+                    summary = ha_test.test_solution(
+                        solution, db_data, uuids, workers_per_row,
+                        ha_test.NUM_TESTS_PER_WORKER, ha_test.BATCH_SIZE,
+                        *workload,
+                        timeline_file=os.path.join(SWEEP_DIR,
+                                                   name + '-timeline.csv'),
+                        store=store,
+                        workers_file=os.path.join(SWEEP_DIR,
+                                                  name + '-workers.csv'))
+                    test_results.display_results(summary)
+                    archive.save(
+                        os.path.join(SWEEP_DIR, name + '.zip'),
+                        {'started': started, 'config': config,
+                         'host': archive.host_info(),
+                         'total_time': {summary.solution: summary.total_time},
+                         'setup_time': {summary.solution: summary.setup_time}},
+                        {summary.solution: store})
+                    # Stored last, as it marks the combination as done
+                    save_summary(path, config, summary)
+                    time.sleep(1)
+                configs.append(config)
+                summaries.append(summary)
+    finally:
+        broker.stop()
+        lock_server.stop()
+        test_results.write_csv(OUTPUT_FILE, summaries, configs=configs,
+                               config_columns=CONFIG_COLUMNS)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,17 +13,32 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import array
 from collections import defaultdict
 import csv
+import functools
+import itertools as it
 import math
-import operator as op
+import time
+
+
+PERCENTILES = (50, 90, 99, 99.9)
 
 
 class ResultDataPoint(object):
     """Object to store results for 1 row change."""
+    __slots__ = ('worker', 'num_test', 'acquire', 'release', 'status',
+                 'profile', 'deadlocks', 'timeouts', 'disconnect', 'backoff',
+                 'polls', 'lag', 'lock_hits', 'lock_misses',
+                 'missed_heartbeats', 'phases', 'finished', 'vol_id',
+                 'switches', 'dlm_changes', 'lost')
+
     def __init__(self, worker=0, num_test=0, status='OK', acquire=0.0,
                  release=0.0, profile=None, deadlocks=0, timeouts=0,
-                 disconnect=0):
+                 disconnect=0, backoff=0.0, polls=0, lag=None, lock_hits=0,
+                 lock_misses=0, missed_heartbeats=0, phases=None,
+                 finished=0.0, vol_id=None, switches=0, dlm_changes=0,
+                 lost=0):
         self.worker = worker
         self.num_test = num_test
         self.acquire = acquire
@@ -33,12 +48,65 @@ class ResultDataPoint(object):
         self.deadlocks = deadlocks
         self.timeouts = timeouts
         self.disconnect = disconnect
+        self.backoff = backoff  # Seconds waited between retries
+        self.polls = polls  # Times the row didn't have the expected status
+        # Replication lag in seconds for each node's IP when measured
+        self.lag = lag
+        # Locks found and not found in the lock cache by tooz solutions
+        self.lock_hits = lock_hits
+        self.lock_misses = lock_misses
+        # Coordinator heartbeats that failed or were late during the change
+        self.missed_heartbeats = missed_heartbeats
+        # Seconds spent in each phase of the changes when instrumented
+        self.phases = phases
+        # Time when the change finished, to place it in the timeline
+        self.finished = finished
+        # Volume changed, comma separated volumes for batches
+        self.vol_id = vol_id
+        # Path switches and changes made with the DLM by adaptive solutions
+        self.switches = switches
+        self.dlm_changes = dlm_changes
+        # Races lost acquiring the volume: times it didn't have the expected
+        # status plus deadlocks and timeouts
+        self.lost = lost
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class WorkloadResult(object):
+    """Times of the operations of an open loop synthetic workload generator.
+
+    For each operation we have when it should have started according to the
+    offered load, when it actually started and when it finished.
+    """
+    def __init__(self, worker=0, rate=0.0):
+        self.worker = worker
+        self.rate = rate  # Offered operations per second
+        self.intended = array.array('d')
+        self.started = array.array('d')
+        self.finished = array.array('d')
+        self.updates = array.array('b')
+
+    def add(self, intended, started, finished, update=False):
+        self.intended.append(intended)
+        self.started.append(started)
+        self.finished.append(finished)
+        self.updates.append(update)
+
+    def __len__(self):
+        return len(self.intended)
 
 
 class Summary(object):
     def __init__(self, total_time=0, solution=None, ok=0, errors=0, stats={},
-                 profile=[]):
+                 profile=[], setup_time=0):
         self.total_time = total_time
+        self.setup_time = setup_time
         self.solution = solution
         self.ok = ok
         self.errors = errors
@@ -46,67 +114,449 @@ class Summary(object):
         self.profile = profile
 
 
-def _calculate_stats(values, factor=1):
-    """Calculate min, max, mean and stddev for values applying a factor."""
-    result = {'min': min(values) * factor,
-              'max': max(values) * factor,
-              'sum': sum(values) * factor,
-              'mean': 0,
-              'stddev': 0}
+class RunningStats(object):
+    """Incrementally calculate min, max, sum, mean and stddev of values.
 
-    if values:
-        mean = sum(values) / float(len(values))
-        result['mean'] = factor * mean
-        result['stddev'] = (
-            factor * math.sqrt((1.0 / (len(values) - 1))
-                               * sum((x - mean) ** 2 for x in values)))
+    Uses Welford's algorithm so values don't need to be stored.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
 
-    return result
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def stats(self, factor=1):
+        """Return min, max, sum, mean and stddev applying a factor."""
+        result = {'min': (self.min or 0) * factor,
+                  'max': (self.max or 0) * factor,
+                  'sum': self.total * factor,
+                  'mean': self.mean * factor,
+                  'stddev': 0}
+
+        if self.count > 1:
+            result['stddev'] = factor * math.sqrt(self.m2 / (self.count - 1))
+
+        return result
+
+
+class Histogram(object):
+    """Log bucketed histogram of values to calculate percentiles.
+
+    Buckets grow geometrically so that any value is within relative_error of
+    its bucket's value, which means memory depends on the range of values
+    and not on how many there are.
+    """
+    def __init__(self, relative_error=0.01):
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = defaultdict(int)
+        self.zeros = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+        else:
+            self.buckets[int(math.ceil(math.log(value) / self.log_gamma))] += 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = int(round(percent / 100.0 * (self.count - 1)))
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if rank < seen:
+                break
+        # The middle of the bucket may be outside of the values we've seen
+        estimate = 2 * self.gamma ** bucket / (self.gamma + 1)
+        return min(max(estimate, self.min), self.max)
+
+    def percentiles(self, factor=1):
+        """Return percentiles in PERCENTILES applying a factor.
 
+        ie: {'p50': 1.2, 'p99': 12.3}
+        """
+        return {'p%s' % p: self.percentile(p) * factor for p in PERCENTILES}
 
-def _prepare_profile(data):
-    """Filter, group and prepare profiling data for printing."""
+
+def _add_profile(result, profile):
+    """Filter and group profiling data of a change into result."""
     PATTERN = "<method '"
 
     def _rename_call(name):
         i = len(PATTERN)
         return name[i:name.index("'", i)]
 
-    result = defaultdict(lambda: {'callcount': 0, 'time': 0.0})
-    for profile in data:
-        for call in profile:
-            if ('sql' in call['name']
-                    and call['name'].startswith(PATTERN)):
-                name = _rename_call(call['name'])
-                result[name]['callcount'] += call['callcount']
-                result[name]['time'] += call['time']
-    return result
+    for call in profile or ():
+        if ('sql' in call['name']
+                and call['name'].startswith(PATTERN)):
+            name = _rename_call(call['name'])
+            result[name]['callcount'] += call['callcount']
+            result[name]['time'] += call['time']
+
+
+def _new_profile():
+    return defaultdict(lambda: {'callcount': 0, 'time': 0.0})
+
+
+def jain_index(values):
+    """Return Jain's fairness index of values, 1 when they are all equal."""
+    total = sum(values)
+    squares = sum(v * v for v in values)
+    if not squares:
+        return 1.0
+    return total * total / (len(values) * squares)
+
+
+class _Contender(object):
+    """Acquire waits and lost races of a worker or of a volume."""
+    __slots__ = ('wait', 'max_wait', 'changes', 'lost', 'max_lost')
+
+    def __init__(self):
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.changes = 0
+        self.lost = 0
+        self.max_lost = 0  # Most races lost on a single change
+
+    def add(self, wait, lost):
+        self.wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.changes += 1
+        self.lost += lost
+        self.max_lost = max(self.max_lost, lost)
+
 
+class Fairness(object):
+    """Acquire waits and lost races of each worker and each volume.
 
-def summarize(solution, total_time, results):
+    Solutions can have good acquire times on average while some workers
+    starve, so we look at how the waits are shared among workers (and
+    volumes) with Jain's fairness index of their total waits.  Races lost on
+    a change are the times the volume didn't have the expected status plus
+    deadlocks and timeouts while acquiring it, releasing doesn't count.
+    """
+    def __init__(self):
+        self.workers = defaultdict(_Contender)
+        self.volumes = defaultdict(_Contender)
+        self.worker_volume = {}
+
+    def add_change(self, worker, vol_id, acquire, lost):
+        self.workers[worker].add(acquire, lost)
+        self.worker_volume[worker] = vol_id
+        if vol_id is not None:
+            self.volumes[vol_id].add(acquire, lost)
+
+    def add(self, result):
+        self.add_change(result.worker, result.vol_id, result.acquire,
+                        result.lost)
+
+    def stats(self):
+        """Return stats of the waits and lost races of workers and volumes.
+
+        Wait stats are of the total wait of each worker or volume, with the
+        Jain's index of those totals and the ratio of the maximum to the mean
+        (starvation).
+        """
+        stats = {}
+        for name, contenders in (('worker', self.workers),
+                                 ('volume', self.volumes)):
+            if not contenders:
+                continue
+            waits = RunningStats()
+            lost = RunningStats()
+            max_lost = RunningStats()
+            for contender in contenders.itervalues():
+                waits.add(contender.wait)
+                lost.add(contender.lost)
+                max_lost.add(contender.max_lost)
+            stats['%s wait' % name] = waits.stats(1000)
+            stats['%s wait' % name].update(
+                jain=jain_index([c.wait for c in contenders.itervalues()]),
+                starvation=waits.max / waits.mean if waits.mean else 1.0)
+            stats['%s lost races' % name] = lost.stats()
+            stats['%s max lost per change' % name] = max_lost.stats()
+        return stats
+
+    def rows(self, float_format='%.02f'):
+        """Return header and a row for each worker."""
+        rows = [['worker', 'volume', 'changes', 'wait', 'wait mean',
+                 'wait max', 'lost races', 'max lost per change']]
+        for worker, c in sorted(self.workers.iteritems()):
+            rows.append([worker, self.worker_volume.get(worker), c.changes,
+                         float_format % (c.wait * 1000),
+                         float_format % (c.wait * 1000 / c.changes),
+                         float_format % (c.max_wait * 1000), c.lost,
+                         c.max_lost])
+        return rows
+
+
+class Aggregator(object):
+    """Summarize results incrementally as they are received.
+
+    Memory doesn't depend on the number of results, so workers can stream
+    them and partial results are available while tests are running.
+    """
+    # Fields to calculate stats on and factor to apply to them
     STATS = (('acquire', 1000), ('release', 1000), ('deadlocks', 1),
-             ('timeouts', 1), ('disconnect', 1))
+             ('timeouts', 1), ('disconnect', 1), ('backoff', 1000),
+             ('polls', 1), ('lock_hits', 1), ('lock_misses', 1),
+             ('missed_heartbeats', 1), ('switches', 1), ('dlm_changes', 1))
+
+    # Fields to calculate percentiles on, besides replication lag
+    HISTOGRAMS = ('acquire', 'release')
+
+    def __init__(self, timeline_window=None, fairness=True):
+        self.ok = 0
+        self.errors = 0
+        self.stats = defaultdict(RunningStats)
+        self.histograms = defaultdict(Histogram)
+        self.profile = _new_profile()
+        self.timeline = timeline_window and Timeline(timeline_window)
+        self.fairness = fairness and Fairness()
 
-    # We'll only display stats on successful results
-    results_ok = tuple(r for r in results if r.status == 'OK')
-    errors = len(results) - len(results_ok)
+    def set_start(self, start):
+        """Make the timeline start when the test actually started."""
+        if self.timeline:
+            self.timeline.start = start
 
-    # Calculate stats for all relevant fields of results
-    stats = {}
-    for var, factor in STATS:
-        stats[var] = _calculate_stats(map(op.attrgetter(var), results_ok),
-                                      factor)
+    def add(self, result):
+        if self.timeline:
+            self.timeline.add(result)
 
-    profile = _prepare_profile(map(op.attrgetter('profile'), results_ok))
+        # We'll only display stats on successful results
+        if result.status != 'OK':
+            self.errors += 1
+            return
+        self.ok += 1
 
-    return Summary(total_time, solution.__name__, len(results_ok), errors,
-                   stats, profile)
+        for var, factor in self.STATS:
+            self.stats[var].add(getattr(result, var))
+        for var in self.HISTOGRAMS:
+            self.histograms[var].add(getattr(result, var))
+        if self.fairness:
+            self.fairness.add(result)
+
+        # Replication lag for all nodes together and for each node
+        for ip, lag in (result.lag or {}).iteritems():
+            for var in ('lag', 'lag %s' % ip):
+                self.stats[var].add(lag)
+                self.histograms[var].add(lag)
+
+        for phase, seconds in (result.phases or {}).iteritems():
+            var = 'phase %s' % phase
+            self.stats[var].add(seconds)
+            self.histograms[var].add(seconds)
+
+        _add_profile(self.profile, result.profile)
+
+    def summary(self, solution, total_time, setup_time=0):
+        factors = dict(self.STATS)
+        stats = {}
+        for var, factor in self.STATS:
+            stats[var] = self.stats[var].stats(factor)
+        for var, values in self.stats.iteritems():
+            if var not in factors:
+                stats[var] = values.stats(1000)
+        for var, histogram in self.histograms.iteritems():
+            stats[var].update(histogram.percentiles(factors.get(var, 1000)))
+        if self.fairness:
+            stats.update(self.fairness.stats())
+
+        return Summary(total_time, solution.__name__, self.ok, self.errors,
+                       stats, self.profile, setup_time)
+
+
+class Timeline(object):
+    """Aggregate results in windows of time by when changes finished.
+
+    Each window has its own Aggregator, so we can see how throughput,
+    latency and retries change during a test (warm up, retry storms...).
+    """
+    # Stats of each window written to the timeline and factor to apply
+    STATS = (('deadlocks', 'sum', 1), ('timeouts', 'sum', 1),
+             ('disconnect', 'sum', 1), ('polls', 'sum', 1),
+             ('backoff', 'sum', 1000), ('missed_heartbeats', 'sum', 1),
+             ('acquire', 'mean', 1000), ('release', 'mean', 1000),
+             ('lag', 'max', 1000))
+
+    # Fields to write percentiles of for each window
+    HISTOGRAMS = ('acquire', 'release')
+
+    def __init__(self, window=1.0, start=None):
+        self.window = window
+        self.start = time.time() if start is None else start
+        # Fairness is only calculated for the whole test
+        self.windows = defaultdict(functools.partial(Aggregator,
+                                                     fairness=False))
+
+    def add(self, result):
+        finished = result.finished or time.time()
+        self.windows[int((finished - self.start) / self.window)].add(result)
+
+    def rows(self, float_format='%.02f'):
+        """Return header and a row for each window, including empty ones."""
+        header = ['time', 'ok', 'errors', 'changes per second']
+        header.extend('%s %s' % (var, stat) for var, stat, _ in self.STATS)
+        for var in self.HISTOGRAMS:
+            header.extend('%s p%s' % (var, p) for p in PERCENTILES)
+        rows = [header]
+
+        for i in xrange(max(self.windows) + 1 if self.windows else 0):
+            aggregator = (self.windows.get(i) or
+                          Aggregator(fairness=False))
+            row = [float_format % (i * self.window), aggregator.ok,
+                   aggregator.errors,
+                   float_format % (aggregator.ok / self.window)]
+            for var, stat, factor in self.STATS:
+                value = aggregator.stats[var].stats(factor)[stat]
+                row.append(float_format % value)
+            for var in self.HISTOGRAMS:
+                percentiles = aggregator.histograms[var].percentiles(1000)
+                row.extend(float_format % percentiles['p%s' % p]
+                           for p in PERCENTILES)
+            rows.append(row)
+        return rows
+
+
+def _add_sparse(columns, values, n):
+    """Add values to columns that are created as needed, NaN if missing."""
+    for key, value in (values or {}).iteritems():
+        if key not in columns:
+            columns[key] = array.array('d', [float('nan')]) * n
+        columns[key].append(value)
+    for column in columns.itervalues():
+        if len(column) == n:
+            column.append(float('nan'))
+
+
+class ResultStore(object):
+    """Columnar storage of results of changes.
+
+    Each field is stored in its own array instead of having an object for
+    each change, so millions of results take a fraction of the memory, to
+    archive them and compare runs.
+    """
+    COLUMNS = (('worker', 'l'), ('num_test', 'l'), ('acquire', 'd'),
+               ('release', 'd'), ('deadlocks', 'l'), ('timeouts', 'l'),
+               ('disconnect', 'l'), ('backoff', 'd'), ('polls', 'l'),
+               ('lock_hits', 'l'), ('lock_misses', 'l'),
+               ('missed_heartbeats', 'l'), ('finished', 'd'),
+               ('switches', 'l'), ('dlm_changes', 'l'), ('lost', 'l'))
+
+    def __init__(self, results=()):
+        self.columns = {name: array.array(typecode)
+                        for name, typecode in self.COLUMNS}
+        self.ok = array.array('b')
+        # Replication lag for each node's IP and time in each phase, NaN when
+        # not measured
+        self.lag = {}
+        self.phases = {}
+        self.vol_ids = []
+
+        for result in results:
+            self.add(result)
+
+    def __len__(self):
+        return len(self.ok)
+
+    def add(self, result):
+        n = len(self)
+        for name, column in self.columns.iteritems():
+            column.append(getattr(result, name))
+        self.ok.append(result.status == 'OK')
+        self.vol_ids.append(result.vol_id)
+
+        _add_sparse(self.lag, result.lag, n)
+        _add_sparse(self.phases, result.phases, n)
+
+    def fairness(self):
+        """Return the Fairness of successful changes."""
+        fairness = Fairness()
+        columns = self.columns
+        for row in it.izip(self.ok, columns['worker'], self.vol_ids,
+                           columns['acquire'], columns['lost']):
+            ok, worker, vol_id, acquire, lost = row
+            if ok:
+                fairness.add_change(worker, vol_id, acquire, lost)
+        return fairness
+
+
+def workload_stats(results):
+    """Return stats of the operations of open loop workload generators.
+
+    Latency is measured from when operations should have started, so it
+    includes the time they were delayed by previous operations (delay), and
+    service is the time they actually took.
+    """
+    stats = defaultdict(RunningStats)
+    histograms = defaultdict(Histogram)
+    starts = []
+    ends = []
+    for result in results:
+        for intended, started, finished in it.izip(
+                result.intended, result.started, result.finished):
+            for var, value in (('latency', finished - intended),
+                               ('service', finished - started),
+                               ('delay', max(0, started - intended))):
+                stats[var].add(value)
+                histograms[var].add(value)
+        if len(result):
+            starts.append(result.intended[0])
+            ends.append(result.finished[-1])
+
+    summary = {}
+    for var, values in stats.iteritems():
+        summary['workload %s' % var] = values.stats(1000)
+        summary['workload %s' % var].update(histograms[var].percentiles(1000))
+
+    # Generators restarted after an error report more than once
+    rates = {result.worker: result.rate for result in results}
+    operations = sum(len(result) for result in results)
+    # All operations can start and end at the same time on coarse clocks
+    duration = max(ends) - min(starts) if ends else 0.0
+    summary['workload rate'] = {
+        'offered': sum(rates.itervalues()),
+        'achieved': operations / duration if duration > 0 else 0.0}
+    return summary
+
+
+def display_progress(aggregator):
+    """Display partial results while tests are running."""
+    acquire = aggregator.stats['acquire']
+    print ('\t%d OK, %d errors, acquire mean %.2fms max %.2fms' %
+           (aggregator.ok, aggregator.errors, acquire.mean * 1000,
+            (acquire.max or 0) * 1000))
 
 
 def display_results(summary):
     """Display results for given a worker test results."""
     print ('Total running time %.2f secs (includes DB checks)'
            % summary.total_time)
+    print 'Setup time %.2f secs (not included)' % summary.setup_time
 
     print 'OK:', summary.ok
     print 'Errors:', summary.errors
@@ -138,20 +588,50 @@ def map_profile_info(profile):
     return result
 
 
-def write_csv(filename, summaries, float_format='%.02f'):
-    """Write all results to CSV a file."""
-    data = [['solution', 'total time', 'ok', 'errors']]
+def write_fairness(filename, fairness, float_format='%.02f'):
+    """Write waits and lost races of each worker to a CSV file."""
+    with open(filename, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        for row in fairness.rows(float_format):
+            writer.writerow(row)
+
+
+def write_timeline(filename, timeline, float_format='%.02f'):
+    """Write results of each window of a timeline to a CSV file."""
+    with open(filename, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        for row in timeline.rows(float_format):
+            writer.writerow(row)
+
 
-    for var, s in summaries[0].stats.iteritems():
-        for stat in s:
-            data[0].append('%s %s' % (var, stat))
+def write_csv(filename, summaries, float_format='%.02f', configs=None,
+              config_columns=()):
+    """Write all results to CSV a file.
 
+    configs has the configuration of each summary, and values for keys in
+    config_columns are written after the solution.
+    """
+    data = [['solution'] + list(config_columns) +
+            ['total time', 'setup time', 'ok', 'errors']]
+
+    # Not all summaries have the same stats (ie: replication lag)
+    columns = []
     for summary in summaries:
-        row = [summary.solution, float_format % summary.total_time, summary.ok,
-               summary.errors]
-        for s in summary.stats.itervalues():
-            for stat in s.itervalues():
-                row.append(float_format % stat)
+        for var, s in summary.stats.iteritems():
+            for stat in s:
+                if (var, stat) not in columns:
+                    columns.append((var, stat))
+                    data[0].append('%s %s' % (var, stat))
+
+    for summary, config in zip(summaries, configs or it.repeat({})):
+        row = ([summary.solution] +
+               [config.get(key, '') for key in config_columns] +
+               [float_format % summary.total_time,
+                float_format % summary.setup_time, summary.ok,
+                summary.errors])
+        for var, stat in columns:
+            value = summary.stats.get(var, {}).get(stat)
+            row.append('' if value is None else float_format % value)
         data.append(row)
 
     with open(filename, 'wb') as csv_file:
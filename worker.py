@@ -14,6 +14,101 @@
 #    limitations under the License.
 
 import multiprocessing as mp
+import threading
+import time
+
+
+POLL_INTERVAL = 0.01  # Seconds between checks of the workers' state
+
+# Queue to stream results to the parent, set on processes created by Tester
+results_queue = None
+
+# Barrier workers wait on before starting, set on processes created by Tester
+start_barrier = None
+
+
+def _set_results_queue(queue):
+    global results_queue
+    results_queue = queue
+
+
+def _init_worker(queue, barrier):
+    global start_barrier
+    _set_results_queue(queue)
+    start_barrier = barrier
+
+
+def report(result):
+    """Stream a result to the parent, returns False if not streaming."""
+    if results_queue is None:
+        return False
+    results_queue.put(result)
+    return True
+
+
+def wait_start():
+    """Wait until all workers are ready, returns False if not synchronized.
+
+    Workers should call it once they have done everything that must not be
+    measured, like connecting to the database.
+    """
+    if start_barrier is None:
+        return False
+    start_barrier.wait()
+    return True
+
+
+class StartBarrier(object):
+    """Barrier that releases workers in all processes at the same time.
+
+    Workers count themselves as ready and wait, and the parent releases
+    them once they are all ready, so it can tell how long it took.
+    """
+    def __init__(self):
+        self.ready = mp.Value('i', 0)
+        self.go = mp.Event()
+
+    def wait(self):
+        with self.ready.get_lock():
+            self.ready.value += 1
+        self.go.wait()
+
+    def release(self):
+        self.go.set()
+
+
+def _consume(queue, consumer):
+    for result in iter(queue.get, None):
+        consumer(result)
+
+
+def _run_threads(worker, calls):
+    """Run each call to worker in its own thread and return their results.
+
+    Like with a process pool, an exception raised by a worker is raised
+    again, but only once all threads have finished.
+    """
+    results = [None] * len(calls)
+    errors = []
+
+    def run(i, args, kwargs):
+        try:
+            results[i] = worker(*args, **kwargs)
+        except Exception as e:
+            errors.append(e)
+            # Don't leave the other threads waiting for this one to start
+            wait_start()
+
+    threads = [threading.Thread(target=run, args=(i, args, kwargs))
+               for i, (args, kwargs) in enumerate(calls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return results
 
 
 class Tester(object):
@@ -26,10 +121,9 @@ class Tester(object):
         self.args = args
         self.kwargs = kwargs
 
-    def run(self, num_workers):
-        pool = mp.Pool(processes=num_workers)
-        workers = []
-
+    def _calls(self, num_workers):
+        """Return the arguments for each of the workers."""
+        calls = []
         for i in xrange(num_workers):
             args = [i]
             args.extend(self.args)
@@ -40,13 +134,110 @@ class Tester(object):
                 kwargs.update(params.get('kwargs', {}))
             except StopIteration:
                 pass
+            calls.append((args, kwargs))
+        return calls
+
+    def _start(self, num_workers, initializer, initargs):
+        """Start workers in a process pool, return the pool and results."""
+        pool = mp.Pool(processes=num_workers, initializer=initializer,
+                       initargs=initargs)
+        workers = [pool.apply_async(self.worker, args, kwargs)
+                   for args, kwargs in self._calls(num_workers)]
+        return pool, workers
+
+    def _results(self, workers):
+        return (w.get() for w in workers)
+
+    def _wait(self, workers, until, progress=None, progress_interval=10):
+        """Wait until the condition is met or all workers have finished."""
+        next_progress = time.time() + progress_interval
+        while not until() and not all(w.ready() for w in workers):
+            time.sleep(POLL_INTERVAL)
+            if progress and time.time() >= next_progress:
+                progress()
+                next_progress += progress_interval
+
+    def run(self, num_workers, consumer=None, progress=None,
+            progress_interval=10, synchronize=False, started=None):
+        """Run workers and return their results.
+
+        If a consumer is given workers can stream their results to it with
+        report while they are running, and progress will be called every
+        progress_interval seconds until all workers have finished.
 
-            workers.append(pool.apply_async(self.worker, args, kwargs))
+        With synchronize workers must call wait_start once they are ready,
+        even if they failed, and are all released at the same time.  How
+        long it took for them to be ready is stored in setup_time, and the
+        times when they were released and when they finished in start_time
+        and end_time.  started is called with start_time right before
+        releasing them.
+        """
+        queue = None
+        if consumer:
+            queue = mp.Queue()
+            reader = threading.Thread(target=_consume,
+                                      args=(queue, consumer))
+            reader.start()
 
+        barrier = StartBarrier() if synchronize else None
+        setup_start = time.time()
+        pool, workers = self._start(num_workers, _init_worker,
+                                    (queue, barrier))
         pool.close()
+
+        # Finished workers mean something went wrong, so don't wait for them
+        if barrier:
+            self._wait(workers,
+                       lambda: (barrier.ready.value >= num_workers or
+                                any(w.ready() for w in workers)))
+        self.start_time = time.time()
+        self.setup_time = self.start_time - setup_start
+        if started:
+            started(self.start_time)
+        if barrier:
+            barrier.release()
+
+        self._wait(workers, lambda: False, progress, progress_interval)
+        self.end_time = time.time()
         pool.join()
-        results = (w.get() for w in workers)
-        return results
+
+        # Workers have flushed their results to the queue before exiting
+        if queue:
+            queue.put(None)
+            reader.join()
+
+        return self._results(workers)
+
+
+class ThreadedTester(Tester):
+    """Tester that runs workers as threads instead of processes.
+
+    Workers are split in as few processes as possible with at most
+    workers_per_process threads each, so we can have thousands of them
+    without running out of memory or PIDs.
+    """
+    def __init__(self, workers_per_process, worker, params=None, *args,
+                 **kwargs):
+        super(ThreadedTester, self).__init__(worker, params, *args, **kwargs)
+        self.workers_per_process = workers_per_process
+
+    def _start(self, num_workers, initializer, initargs):
+        calls = self._calls(num_workers)
+        size = self.workers_per_process
+        shards = [calls[i:i + size] for i in xrange(0, len(calls), size)]
+        pool = mp.Pool(processes=len(shards), initializer=initializer,
+                       initargs=initargs)
+        workers = [pool.apply_async(_run_threads, (self.worker, shard))
+                   for shard in shards]
+        return pool, workers
+
+    def _results(self, workers):
+        return (r for w in workers for r in w.get())
+
+
+def _run_reporting(queue, worker, *args, **kwargs):
+    _set_results_queue(queue)
+    return worker(*args, **kwargs)
 
 
 class Workloader(object):
@@ -61,9 +252,9 @@ class Workloader(object):
 
         self.stop = mp.Value('b', False)
 
-    def run(self, num_workers):
-        self.workers = []
-
+    def _calls(self, num_workers):
+        """Return the arguments for each of the workers."""
+        calls = []
         for i in xrange(num_workers):
             args = [i, self.stop]
             args.extend(self.args)
@@ -74,18 +265,62 @@ class Workloader(object):
                 kwargs.update(params.get('kwargs', {}))
             except StopIteration:
                 pass
+            calls.append((args, kwargs))
+        return calls
 
-            worker = mp.Process(target=self.worker, args=args, kwargs=kwargs)
-            self.workers.append(worker)
+    def _processes(self, num_workers):
+        """Return a process for each worker."""
+        return [mp.Process(target=_run_reporting,
+                           args=[self.queue, self.worker] + args,
+                           kwargs=kwargs)
+                for args, kwargs in self._calls(num_workers)]
 
+    def run(self, num_workers, consumer=None):
+        """Start workers, which can report results to consumer."""
+        self.queue = None
+        if consumer:
+            self.queue = mp.Queue()
+            self.reader = threading.Thread(target=_consume,
+                                           args=(self.queue, consumer))
+            self.reader.start()
+
+        self.workers = self._processes(num_workers)
         for w in self.workers:
             w.start()
 
         return self.stop
 
     def finish(self):
+        """Stop workers and return the exit code of their processes."""
         self.stop.value = True
 
         for w in self.workers:
             w.join()
-        return (w.exitcode() for w in self.workers)
+
+        # Workers have flushed their results to the queue before exiting
+        if self.queue:
+            self.queue.put(None)
+            self.reader.join()
+        return [w.exitcode for w in self.workers]
+
+
+class ThreadedWorkloader(Workloader):
+    """Workloader that runs workers as threads instead of processes.
+
+    Like ThreadedTester workers are split in as few processes as possible
+    with at most workers_per_process threads each, so we can have thousands
+    of them without the overhead of a process for each one.
+    """
+    def __init__(self, workers_per_process, worker, params=None, *args,
+                 **kwargs):
+        super(ThreadedWorkloader, self).__init__(worker, params, *args,
+                                                 **kwargs)
+        self.workers_per_process = workers_per_process
+
+    def _processes(self, num_workers):
+        calls = self._calls(num_workers)
+        size = self.workers_per_process
+        return [mp.Process(target=_run_reporting,
+                           args=(self.queue, _run_threads, self.worker,
+                                 calls[i:i + size]))
+                for i in xrange(0, len(calls), size)]
@@ -15,49 +15,77 @@
 
 # Synthetic workload generator for DB selects and updates
 
+import random
 import time
 import uuid
 
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
 import db
+import test_results
+import worker
 
 
 @db.retry_on_operational_error
 def do_workload(worker_id, stop, db_data, num_selects=10, num_updates=5,
-                *args, **kwargs):
+                open_loop=False, *args, **kwargs):
+    """Make num_selects selects and num_updates updates per second.
+
+    Closed loop generators wait a fixed time after each operation, so they
+    make less operations when the DB is slow.  Open loop generators start
+    operations at Poisson arrival times regardless of how long previous
+    operations took, and report when each operation should have started,
+    when it started and when it finished.
+    """
     total_operations = num_selects + num_updates
     wait_time = 1.0 / total_operations
     operations = tuple(range(total_operations))
 
-    database = db.Db(session_cfg={'autocommit': True,
-                                  'expire_on_commit': True},
-                     **db_data)
-
-    # Add a specific volume for our workload
-    while True:
-        my_uuid = uuid.uuid1()
-        try:
-            with database.session.begin():
-                database.session.add(db.Volume(id=my_uuid,
-                                               status='available'))
-                break
-        except IntegrityError:
-            pass
-
-    # While shared stop value doesn't change
-    while not stop.value:
-        for i in operations:
-            with database.session.begin():
-                if i < num_selects:
-                    v = database.session.query(db.Volume).get(my_uuid)
-                else:
-                    v.attach_status = '%s-%s' % (worker_id, i)
-            time.sleep(wait_time)
+    # Generators running as threads in the same process share the engine, but
+    # each one keeps a connection so it always goes to the same node
+    connection = db.db_pool.get(db_data).get_engine().connect()
+    session = Session(bind=connection, autocommit=True, expire_on_commit=True)
 
-    # We remove our volume after we have finished the tests
-    with database.session.begin():
-        database.session.delete(v)
+    samples = test_results.WorkloadResult(worker_id, total_operations)
+    try:
+        # Add a specific volume for our workload
+        while True:
+            my_uuid = str(uuid.uuid1())
+            try:
+                with session.begin():
+                    v = db.Volume(id=my_uuid, status='available')
+                    session.add(v)
+                    break
+            except IntegrityError:
+                pass
+
+        next_start = time.time()
+        # While shared stop value doesn't change
+        while not stop.value:
+            for i in operations:
+                if open_loop:
+                    next_start += random.expovariate(total_operations)
+                    time.sleep(max(0, next_start - time.time()))
+                started = time.time()
+                with session.begin():
+                    if i < num_selects:
+                        v = session.query(db.Volume).get(my_uuid)
+                    else:
+                        v.attach_status = '%s-%s' % (worker_id, i)
+                if open_loop:
+                    samples.add(next_start, started, time.time(),
+                                i >= num_selects)
+                else:
+                    time.sleep(wait_time)
 
-    database.close()
+        # We remove our volume after we have finished the tests
+        with session.begin():
+            session.delete(v)
+    finally:
+        # Operations made before a retry are reported too
+        if open_loop:
+            worker.report(samples)
+        session.close()
+        connection.close()
     return True